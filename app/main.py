@@ -1,15 +1,21 @@
-import logging
 import os
+import time
+from contextlib import nullcontext
 
 from aiogram import Bot
 from aiogram import types, Dispatcher
 from aiogram.types import BotCommand
 from aiogram.utils.exceptions import BadRequest
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
-from starlette.templating import Jinja2Templates
+from starlette import status
+from starlette.responses import Response
 
 from config.bot_config import bot, dp, TOKEN
+from config.middlewares import MetricsMiddleware, UserContextMiddleware
+from config.update_queue import UpdateQueue
+from database.db_async import migrate_images, migrate_orders, bump_menu_version
+from database.profiler import profile_request
 from handlers.add_order.add_order import register_handlers_add_order
 from handlers.admin.add_product import register_handlers_add_product
 from handlers.admin.admin import register_handlers_admin
@@ -19,14 +25,17 @@ from handlers.common import register_handlers_common
 from handlers.get_menu.get_menu import register_handlers_menu
 from handlers.registration.registration import register_handlers_registration
 from handlers.shopping_cart.get_shopping_cart import register_handlers_cart
-from routes import get_home, contact
+from metrics import Gauge, Histogram
+from routes import get_home, get_image, contact, get_metrics
+from sending_email import outbox
 from settings import setup_logger
 
 app = FastAPI()
 app.add_api_route("/", get_home, methods=["GET"])
+app.add_api_route("/images/{image_hash}", get_image, methods=["GET"])
 app.add_api_route("/contact", contact, methods=["POST"])
+app.add_api_route("/metrics", get_metrics, methods=["GET"])
 
-templates = Jinja2Templates(directory=fr"app/templates")
 app.mount('/static', StaticFiles(directory='app/static'), name='static')
 
 logger = setup_logger('app')
@@ -34,6 +43,13 @@ logger = setup_logger('app')
 WEBHOOK_PATH = f"/bot/{TOKEN}"
 WEBHOOK_URL = os.getenv('HOST_URL') + WEBHOOK_PATH
 
+_bot_started = False
+
+http_request_duration = Histogram('http_request_duration_seconds', 'Duration of HTTP requests',
+                                  ('endpoint', 'status'))
+webhook_updates = Gauge('webhook_updates_in_progress', 'Telegram updates being processed')
+webhook_queue_depth = Gauge('webhook_queue_depth', 'Telegram updates waiting to be processed')
+
 
 async def set_commands(bot_: Bot):
     """Creating a bot menu
@@ -49,11 +65,19 @@ async def set_commands(bot_: Bot):
 
 
 async def bot_main():
-    """Bot launch
+    """Bot launch: registering handlers and the bot menu.
+    Runs once per process, repeated calls do nothing
 
     :return: None
     """
-    logging.info('Starting bot')
+    global _bot_started
+    if _bot_started:
+        return
+    _bot_started = True
+
+    logger.info('Starting bot')
+    dp.middleware.setup(MetricsMiddleware())
+    dp.middleware.setup(UserContextMiddleware())
     register_handlers_common(dp)
     register_handlers_registration(dp)
     register_handlers_authorization(dp)
@@ -64,15 +88,41 @@ async def bot_main():
     register_handlers_add_order(dp)
     register_handlers_cart(dp)
 
-    await set_commands(bot)
+    try:
+        await set_commands(bot)
+    except Exception as ex:
+        logger.error(repr(ex))
+
+
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    """Measuring HTTP requests by endpoint name, the webhook path contains the bot token.
+    Statements of the request are summarized when the SQL profiler is enabled,
+    the webhook only queues updates and their processing is profiled by process_update
+
+    :param request:
+    :param call_next:
+    :return:
+    """
+    started = time.perf_counter()
+    with nullcontext() if request.url.path == WEBHOOK_PATH else profile_request(request.url.path):
+        response = await call_next(request)
+    endpoint = getattr(request.scope.get('endpoint'), '__name__', 'other')
+    http_request_duration.observe(time.perf_counter() - started, endpoint=endpoint, status=response.status_code)
+    return response
 
 
 @app.on_event("startup")
 async def on_startup():
-    """Setting up a webhook
+    """Bot launch, data migrations, images maintenance and setting up a webhook
 
     :return:
     """
+    await bot_main()
+    await migrate_images()
+    await migrate_orders()
+    await bump_menu_version()  # pages cached by browsers before a restart or a restored backup are not reused
+
     try:
         webhook_info = await bot.get_webhook_info()
         if webhook_info.url != WEBHOOK_URL:
@@ -82,34 +132,62 @@ async def on_startup():
             )
     except BadRequest as ex:
         if "ip address 127.0.0.1 is reserved" in str(ex):
-            logging.error('ip address 127.0.0.1 is reserved')
+            logger.error('ip address 127.0.0.1 is reserved')
         else:
-            logging.error(repr(ex))
+            logger.error(repr(ex))
+
+
+async def process_update(update: types.Update):
+    """Processing a queued Telegram update, runs in an update queue worker
+
+    :param update: Telegram update
+    :return:
+    """
+    webhook_updates.inc()
+    try:
+        Dispatcher.set_current(dp)
+        Bot.set_current(bot)
+        with profile_request('update'):
+            await dp.process_update(update)
+    finally:
+        webhook_updates.dec()
+
+
+update_queue = UpdateQueue(process_update)
+webhook_queue_depth.set_function(update_queue.depth)
 
 
 @app.post(WEBHOOK_PATH)
 async def bot_webhook(update: dict):
-    """Getting Telegram updates
+    """Getting Telegram updates. The update is queued and Telegram gets the response at once,
+    so slow handlers don't make Telegram deliver the update again
 
     :param update: Telegram update
     :return:
     """
     try:
         telegram_update = types.Update(**update)
-        Dispatcher.set_current(dp)
-        Bot.set_current(bot)
-        await bot_main()
-        await dp.process_update(telegram_update)
     except Exception as ex:
-        logging.error(repr(ex))
+        logger.error(f'Invalid update: {repr(ex)}')
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+    if not isinstance(telegram_update.update_id, int):
+        logger.error(f'Invalid update without id: {update}')
+        return Response(status_code=status.HTTP_400_BAD_REQUEST)
+
+    if not await update_queue.put(telegram_update):
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response(status_code=status.HTTP_200_OK)
 
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    """Closing session and delete webhook
+    """Processing queued updates, sending queued messages and emails, closing session and delete webhook
 
     :return:
     """
+    await update_queue.close()
+    await bot.send_queue.close()
+    await outbox.close()
     await dp.storage.close()
     await dp.storage.wait_closed()
     await bot.session.close()
@@ -1,42 +1,106 @@
-import base64
+import asyncio
 import os
+import re
 
 from fastapi import Request
 from starlette import status
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, FileResponse, Response, HTMLResponse
+from starlette.templating import Jinja2Templates
 
-from database.db_middleware import get_all_values
-from database.models import Product
-from sending_email import send_email
+from database.db_async import get_product_summaries, get_menu_version
+from database.image_store import image_path, stored_image_media_type
+from metrics import CONTENT_TYPE, render
+from sending_email import create_email, outbox
+
+IMAGE_HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+IMAGE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+templates = Jinja2Templates(directory=fr"app/templates")
+
+# menu version -> rendered home page, only the current version is kept.
+# The page uses paths without the host, so it doesn't depend on the request
+home_page_cache: dict[int, bytes] = {}
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Checking the If-None-Match request header
+
+    :param request:
+    :param etag: current ETag of the resource
+    :return: True if the client already has the current version
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return etag in tags or '*' in tags
 
 
 async def get_home(request: Request):
-    """Home page
+    """Home page. The rendered page is cached until products are changed
 
     :param request:
     :return:
     """
-    from app.main import templates
+    version = await get_menu_version()
+    headers = {'ETag': f'"home-{version}"', 'Cache-Control': 'no-cache'}
+    if etag_matches(request, headers['ETag']):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
-    products = get_all_values(Product)
-    available_products = []
-    for product in products:
-        if product.is_available:
-            image_data = product.image_data
+    body = home_page_cache.get(version)
+    if body is None:
+        body = await render_home(request)
+        home_page_cache.clear()
+        home_page_cache[version] = body
 
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
+    return HTMLResponse(body, headers=headers)
 
-            available_products.append({
-                'photo_base64': image_base64,
-                'name': product.name,
-                'price': product.price,
-            })
 
+async def render_home(request: Request) -> bytes:
+    """Home page rendering
+
+    :param request:
+    :return: page content
+    """
+    products = await get_product_summaries()
+    available_products = []
+    for product in products:
+        available_products.append({
+            'image_hash': product.thumbnail_hash,
+            'name': product.name,
+            'price': product.price,
+        })
+
+    # a path instead of url_for, which would put the request host into the cached page
+    styles_url = request.scope.get('root_path', '') + request.app.url_path_for('static', path='css/styles.css')
     response = templates.TemplateResponse("index.html", {
         "request": request,
-        "available_products": available_products
+        "available_products": available_products,
+        "styles_url": styles_url,
     })
-    return response
+    return response.body
+
+
+async def get_image(image_hash: str, request: Request):
+    """Product image by its SHA-256.
+    The content behind a hash never changes, so browsers and proxies may cache it forever
+
+    :param image_hash: SHA-256 of the image
+    :param request:
+    :return:
+    """
+    if not IMAGE_HASH_PATTERN.match(image_hash):
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+
+    headers = {'ETag': f'"{image_hash}"', 'Cache-Control': IMAGE_CACHE_CONTROL}
+    if etag_matches(request, headers['ETag']):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    media_type = await asyncio.to_thread(stored_image_media_type, image_hash)
+    if media_type is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+
+    return FileResponse(image_path(image_hash), media_type=media_type, headers=headers)
 
 
 async def contact(request: Request):
@@ -53,11 +117,18 @@ async def contact(request: Request):
     admin_email = os.getenv('ADMIN_EMAIL')
 
     sender_email = os.getenv('ADMIN_EMAIL')
-    sender_password = os.getenv('ADMIN_EMAIL_PASSWORD')
     receiver_email = admin_email
     subject = message
     message = f'Сообщение от пользователя {name} <{email}>: {message}'
 
-    send_email(sender_email, sender_password, receiver_email, subject, message)
+    outbox.send(create_email(sender_email, receiver_email, subject, message))
 
     return RedirectResponse(url="/", status_code=status.HTTP_303_SEE_OTHER)
+
+
+async def get_metrics():
+    """Metrics of the bot and the site in the Prometheus text format
+
+    :return:
+    """
+    return Response(render(), headers={'Content-Type': CONTENT_TYPE})
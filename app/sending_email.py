@@ -1,22 +1,182 @@
+import asyncio
+import logging
+import os
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+logger = logging.getLogger('app')
 
-def send_email(sender_email, sender_password, receiver_email, subject, message):
-    from main import logger
+SMTP_HOST = os.getenv('SMTP_HOST', 'smtp.gmail.com')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 587))
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', '1') == '1'
+SMTP_BATCH_SIZE = int(os.getenv('SMTP_BATCH_SIZE', 20))  # messages sent over the connection at once
+SMTP_RETRIES = int(os.getenv('SMTP_RETRIES', 5))
+SMTP_IDLE_TIMEOUT = int(os.getenv('SMTP_IDLE_TIMEOUT', 60))  # seconds before an unused connection is closed
+
+# errors after which the connection is dropped and the rest of the batch is retried
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError, OSError)
+
+
+def create_email(sender_email, receiver_email, subject, message) -> MIMEMultipart:
     msg = MIMEMultipart()
     msg['From'] = sender_email
     msg['To'] = receiver_email
     msg['Subject'] = subject
     msg.attach(MIMEText(message, 'plain'))
+    return msg
+
+
+class MailOutbox:
+    """Sending emails in the background.
+    Messages are queued without waiting, a worker sends them in batches over one authenticated
+    SMTP connection that is kept open between batches. Failed messages are retried with exponential backoff"""
+
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, username: str = None, password: str = None,
+                 starttls: bool = SMTP_STARTTLS, batch_size: int = SMTP_BATCH_SIZE, retries: int = SMTP_RETRIES,
+                 idle_timeout: float = SMTP_IDLE_TIMEOUT, backoff: float = 1):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.batch_size = batch_size
+        self.retries = retries
+        self.idle_timeout = idle_timeout
+        self.backoff = backoff
+        self.connection: smtplib.SMTP | None = None
+        self.queue: asyncio.Queue | None = None
+        self.worker: asyncio.Task | None = None
+        self.retrying: set[asyncio.Task] = set()
+
+    def send(self, msg: MIMEMultipart, attempt: int = 0):
+        """Queueing a message, it is sent by the background worker
+
+        :param msg: message
+        :param attempt: number of failed attempts
+        :return:
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.work())
+        self.queue.put_nowait((msg, attempt))
+
+    async def work(self):
+        while True:
+            try:
+                batch = [await asyncio.wait_for(self.queue.get(), self.idle_timeout)]
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self.disconnect)
+                continue
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            failed = await asyncio.to_thread(self.deliver, batch)
+            for msg, attempt in failed:
+                self.retry(msg, attempt + 1)
+            for _ in batch:
+                self.queue.task_done()
+
+    def retry(self, msg: MIMEMultipart, attempt: int):
+        if attempt > self.retries:
+            logger.error(f'Message to <{msg["To"]}> not sent after {self.retries} retries')
+            return
+
+        delay = self.backoff * 2 ** (attempt - 1)
+        logger.warning(f'Message to <{msg["To"]}> not sent, retrying in {delay} s')
+
+        async def send_later():
+            await asyncio.sleep(delay)
+            self.send(msg, attempt)
+
+        task = asyncio.create_task(send_later())
+        self.retrying.add(task)
+        task.add_done_callback(self.retrying.discard)
+
+    def connect(self) -> smtplib.SMTP:
+        if self.connection is not None:
+            return self.connection
+        logger.info(f'Connecting to SMTP server <{self.host}:{self.port}>')
+
+        connection = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            if self.starttls:
+                connection.starttls()
+            if self.username:
+                connection.login(self.username, self.password)
+        except Exception:
+            connection.close()
+            raise
+        self.connection = connection
+        return connection
+
+    def disconnect(self):
+        if self.connection is None:
+            return
+        try:
+            self.connection.quit()
+        except smtplib.SMTPException:
+            self.connection.close()
+        except OSError:
+            pass
+        self.connection = None
+
+    def deliver(self, batch: list[tuple[MIMEMultipart, int]]) -> list[tuple[MIMEMultipart, int]]:
+        """Sending a batch of messages over the shared connection, runs in a thread
+
+        :param batch: (message, attempt)
+        :return: messages to retry
+        """
+        if self.connection is not None:
+            try:
+                self.connection.noop()  # the server may have closed the connection while it was idle
+            except (smtplib.SMTPException, OSError):
+                self.disconnect()
+
+        failed = []
+        for number, (msg, attempt) in enumerate(batch):
+            try:
+                self.connect().send_message(msg)
+                logger.info(f'Message to <{msg["To"]}> sent')
+            except smtplib.SMTPAuthenticationError as ex:  # wrong credentials, retrying won't help
+                logger.error(f'SMTP authentication failed, {len(batch) - number} messages not sent: {repr(ex)}')
+                break
+            except CONNECTION_ERRORS as ex:
+                logger.warning(f'SMTP connection failed: {repr(ex)}')
+                self.disconnect()
+                failed.extend(batch[number:])
+                break
+            except smtplib.SMTPResponseException as ex:
+                if 400 <= ex.smtp_code < 500:  # temporary failure, like a greylisted or busy server
+                    failed.append((msg, attempt))
+                else:
+                    logger.error(f'Message to <{msg["To"]}> rejected: {repr(ex)}')
+            except smtplib.SMTPException as ex:
+                logger.error(f'Message to <{msg["To"]}> rejected: {repr(ex)}')
+        return failed
+
+    async def close(self, timeout: float = 10):
+        """Sending queued messages and closing the connection
+
+        :param timeout: seconds to wait for queued messages
+        :return:
+        """
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f'{self.queue.qsize()} messages not sent before shutdown')
+        if self.worker is not None:
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+        if self.retrying:
+            logger.error(f'{len(self.retrying)} messages waiting for a retry not sent before shutdown')
+        retrying = list(self.retrying)
+        for task in retrying:
+            task.cancel()
+        await asyncio.gather(*retrying, return_exceptions=True)
+        await asyncio.to_thread(self.disconnect)
+
 
-    try:
-        smtp_server = smtplib.SMTP('smtp.gmail.com', 587)
-        smtp_server.starttls()
-        smtp_server.login(sender_email, sender_password)
-        smtp_server.send_message(msg)
-        smtp_server.quit()
-        logger.info(f'Message from user <{sender_email}> sent')
-    except smtplib.SMTPException as ex:
-        logger.error("Error sending message:", repr(ex))
+outbox = MailOutbox(username=os.getenv('ADMIN_EMAIL'), password=os.getenv('ADMIN_EMAIL_PASSWORD'))
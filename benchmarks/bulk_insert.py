@@ -0,0 +1,62 @@
+"""Bulk insert benchmark
+
+Inserts the same orders, referencing users and products by name, with add_order
+(one session and commit per row) and with add_orders (names resolved at once, chunked executemany).
+The benchmark works on a temporary database, bot_db.db is not touched.
+
+Usage:
+    python benchmarks/bulk_insert.py [orders] [chunk size]
+"""
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from database import db_middleware  # noqa: E402
+from database.models import Base, create_db_engine  # noqa: E402
+
+USERS = 50
+PRODUCTS = 20
+
+
+def prepare_database(path: str):
+    db_middleware.engine = create_db_engine(path)
+    Base.metadata.create_all(bind=db_middleware.engine)
+
+    photo_path = os.path.join(ROOT_DIR, 'tests', 'test_images', 'test.jpg')
+    for number in range(PRODUCTS):
+        db_middleware.add_product(f'Product {number}', 10.0 + number, photo_path=photo_path, is_available=True)
+    for number in range(USERS):
+        db_middleware.add_user(f'User {number}', 'Address', 'password', '123456789', tg_id=number + 1)
+
+
+def create_orders(count: int) -> list[dict]:
+    now = datetime.datetime.now()
+    return [{'user': f'User {number % USERS}', 'product': f'Product {number % PRODUCTS}',
+             'order_time': now, 'quantity': number % 5 + 1} for number in range(count)]
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else db_middleware.BULK_CHUNK_SIZE
+    orders = create_orders(count)
+
+    print(f'{"path":>10} | {"seconds":>8} | {"rows/s":>8} | {"failed":>6}')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        prepare_database(os.path.join(temp_dir, 'bench.db'))
+
+        started = time.perf_counter()
+        failed = sum(db_middleware.add_order(**order) is None for order in orders)
+        elapsed = time.perf_counter() - started
+        print(f'{"add_order":>10} | {elapsed:>8.2f} | {count / elapsed:>8.0f} | {failed:>6}')
+
+        started = time.perf_counter()
+        result = db_middleware.add_orders(orders, chunk_size)
+        elapsed = time.perf_counter() - started
+        print(f'{"add_orders":>10} | {elapsed:>8.2f} | {count / elapsed:>8.0f} | {len(result.failed):>6}')
+
+        db_middleware.engine.dispose()
@@ -0,0 +1,109 @@
+"""Database concurrency benchmark
+
+Simulates simultaneous users opening their cart (user lookup + cart query) and compares
+calling db_middleware directly on the event loop with awaiting db_async.
+Prints throughput and the longest event loop stall for every number of users.
+The benchmark works on a temporary database, bot_db.db is not touched.
+
+Usage:
+    python benchmarks/db_concurrency.py [requests per user]
+"""
+import asyncio
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from sqlalchemy import create_engine  # noqa: E402
+
+from database import db_async, db_middleware  # noqa: E402
+from database.models import Base  # noqa: E402
+
+USERS = (1, 2, 4, 8, 16, 32)
+PRODUCTS = 20
+ORDERS_PER_USER = 10
+
+
+def prepare_database(path: str):
+    """Creating a temporary database with users, products and orders
+
+    :param path: database file path
+    :return:
+    """
+    db_middleware.engine = create_engine(f'sqlite:///{path}')
+    Base.metadata.create_all(bind=db_middleware.engine)
+
+    photo_path = os.path.join(ROOT_DIR, 'tests', 'test_images', 'test.jpg')
+    for number in range(PRODUCTS):
+        db_middleware.add_product(f'Product {number}', 10.0 + number, photo_path=photo_path, is_available=True)
+    for tg_id in range(1, max(USERS) + 1):
+        db_middleware.add_user(f'User {tg_id}', 'Address', 'password', '123456789', tg_id=tg_id)
+        user_id = db_middleware.get_user_id_by_tg_id(tg_id)
+        for number in range(ORDERS_PER_USER):
+            db_middleware.add_order(user=user_id, order_time=datetime.datetime.now(),
+                                    product=number % PRODUCTS + 1, quantity=2)
+
+
+def view_cart_sync(tg_id: int) -> list:
+    user_id = db_middleware.get_user_id_by_tg_id(tg_id)
+    return list(db_middleware.get_user_cart_by_id(user_id))
+
+
+async def view_cart_async(tg_id: int) -> list:
+    user_id = await db_async.get_user_id_by_tg_id(tg_id)
+    return await db_async.get_user_cart_by_id(user_id)
+
+
+async def measure(users: int, requests: int, use_async: bool) -> tuple[float, float]:
+    """Running concurrent users
+
+    :param users: number of simultaneous users
+    :param requests: cart views per user
+    :param use_async: use db_async instead of db_middleware
+    :return: requests per second and the longest event loop stall in milliseconds
+    """
+    max_stall = 0.0
+    finished = False
+
+    async def ticker():
+        nonlocal max_stall
+        while not finished:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            max_stall = max(max_stall, time.perf_counter() - started - 0.001)
+
+    async def user(tg_id: int):
+        for _ in range(requests):
+            if use_async:
+                await view_cart_async(tg_id)
+            else:
+                view_cart_sync(tg_id)
+                await asyncio.sleep(0)
+
+    ticker_task = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(user(tg_id) for tg_id in range(1, users + 1)))
+    elapsed = time.perf_counter() - started
+    finished = True
+    await ticker_task
+
+    return users * requests / elapsed, max_stall * 1000
+
+
+async def run(requests: int):
+    print(f'{"users":>5} | {"sync req/s":>10} {"stall ms":>8} | {"async req/s":>11} {"stall ms":>8}')
+    for users in USERS:
+        sync_rps, sync_stall = await measure(users, requests, use_async=False)
+        async_rps, async_stall = await measure(users, requests, use_async=True)
+        print(f'{users:>5} | {sync_rps:>10.0f} {sync_stall:>8.1f} | {async_rps:>11.0f} {async_stall:>8.1f}')
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as temp_dir:
+        prepare_database(os.path.join(temp_dir, 'bench.db'))
+        asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 50))
+        db_middleware.engine.dispose()
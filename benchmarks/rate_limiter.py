@@ -0,0 +1,87 @@
+"""Rate limiter benchmark
+
+Sends requests from many distinct users through the old antispam cache
+(TTLCache(maxsize=rate, ttl=interval)) and through the limiters in config.rate_limit.
+Every user sends more requests than the limit allows, so the number of allowed requests
+shows whether the limit holds. Prints requests per second, allowed requests and tracked users.
+The SQLite limiter works on a temporary database, bot_db.db is not touched.
+
+Usage:
+    python benchmarks/rate_limiter.py [users] [requests per user]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bot'))
+
+from cachetools import TTLCache  # noqa: E402
+
+from config.rate_limit import MemoryRateLimiter, SQLiteRateLimiter  # noqa: E402
+from database import db_middleware  # noqa: E402
+from database.models import Base, create_db_engine  # noqa: E402
+
+RATE = 3
+# long enough for all requests of a run to fall into one interval
+INTERVAL = 3600
+
+
+class TTLCacheLimiter:
+    """The antispam cache before config.rate_limit"""
+
+    def __init__(self, rate: int, interval: float):
+        self.rate = rate
+        self.cache = TTLCache(maxsize=rate, ttl=interval)
+
+    async def hit(self, key) -> bool:
+        if key in self.cache:
+            if self.cache[key] >= self.rate:
+                return False
+            self.cache[key] += 1
+        else:
+            self.cache[key] = 1
+        return True
+
+    def __len__(self):
+        return len(self.cache)
+
+
+async def run(limiter, users: int, requests: int) -> tuple[float, int]:
+    allowed = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        for user_id in range(users):
+            allowed += await limiter.hit(user_id)
+    return time.perf_counter() - started, allowed
+
+
+def report(name: str, limiter, users: int, requests: int):
+    tracemalloc.start()
+    elapsed, allowed = asyncio.run(run(limiter, users, requests))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tracked = len(limiter) if hasattr(limiter, '__len__') else users
+    print(f'{name:>10} | {users * requests / elapsed:>10.0f} | {allowed:>8} | {users * RATE:>8} | '
+          f'{tracked:>7} | {peak / 2 ** 20:>7.1f}')
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else RATE + 2
+
+    print(f'{"limiter":>10} | {"req/s":>10} | {"allowed":>8} | {"expected":>8} | {"tracked":>7} | {"peak MB":>7}')
+    report('ttlcache', TTLCacheLimiter(RATE, INTERVAL), users, requests)
+    report('memory', MemoryRateLimiter(RATE, INTERVAL), users, requests)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_middleware.engine = create_db_engine(os.path.join(temp_dir, 'bench.db'))
+        Base.metadata.create_all(bind=db_middleware.engine)
+        # the database round trip dominates, a tenth of the users is enough for the rate
+        report('sqlite', SQLiteRateLimiter(RATE, INTERVAL, 'bench'), max(users // 10, 1), requests)
+        db_middleware.engine.dispose()
@@ -0,0 +1,81 @@
+"""SQLite profile benchmark
+
+Runs a mixed workload (cart reads and order inserts) from several threads,
+the same way the database thread pool does, for every profile in SQLITE_PROFILES.
+Prints operations per second and the number of failed operations ("database is locked").
+The benchmark works on temporary databases, bot_db.db is not touched.
+
+Usage:
+    python benchmarks/sqlite_profile.py [seconds per profile] [threads]
+"""
+import datetime
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from database import db_middleware  # noqa: E402
+from database.models import Base, SQLITE_PROFILES, create_db_engine  # noqa: E402
+
+USERS = 50
+PRODUCTS = 20
+WRITE_SHARE = 0.3
+
+
+def prepare_database(path: str, profile: str):
+    db_middleware.engine = create_db_engine(path, profile)
+    Base.metadata.create_all(bind=db_middleware.engine)
+
+    photo_path = os.path.join(ROOT_DIR, 'tests', 'test_images', 'test.jpg')
+    for number in range(PRODUCTS):
+        db_middleware.add_product(f'Product {number}', 10.0 + number, photo_path=photo_path, is_available=True)
+    for tg_id in range(1, USERS + 1):
+        db_middleware.add_user(f'User {tg_id}', 'Address', 'password', '123456789', tg_id=tg_id)
+
+
+def worker(deadline: float, counters: dict, lock: threading.Lock):
+    operations = failures = 0
+    while time.perf_counter() < deadline:
+        user_id = random.randint(1, USERS)
+        if random.random() < WRITE_SHARE:
+            order = db_middleware.add_order(user=user_id, order_time=datetime.datetime.now(),
+                                            product=random.randint(1, PRODUCTS), quantity=1)
+            if order is None:
+                failures += 1
+        else:
+            list(db_middleware.get_user_cart_by_id(user_id))
+        operations += 1
+
+    with lock:
+        counters['operations'] += operations
+        counters['failures'] += failures
+
+
+def run(seconds: float, threads: int) -> dict:
+    counters = {'operations': 0, 'failures': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(worker, deadline, counters, lock) for _ in range(threads)]
+    for future in futures:
+        future.result()
+    return counters
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    print(f'{"profile":>10} | {"ops/s":>8} | {"failed":>6}')
+    for profile in SQLITE_PROFILES:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            prepare_database(os.path.join(temp_dir, 'bench.db'), profile)
+            counters = run(seconds, threads)
+            db_middleware.engine.dispose()
+        print(f'{profile:>10} | {counters["operations"] / seconds:>8.0f} | {counters["failures"]:>6}')
@@ -0,0 +1,74 @@
+"""Webhook latency benchmark
+
+Calls ``bot_main`` once, as the startup event does, then posts 10k Telegram updates to ``bot_webhook`` one
+after another. The webhook only queues an update, the update queue workers process it in the background,
+so the latency printed for every 1k batch is the time the webhook takes to accept an update while earlier
+ones are being processed. The number of registered message handlers is printed with it and stays the same,
+because handlers are registered once. At the end the queue is drained and the total time is printed.
+No network access is needed: the updates match no handler and ``set_my_commands`` is replaced with a stub.
+
+Usage:
+    python benchmarks/webhook_latency.py [updates]
+"""
+import asyncio
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, 'bot'), os.path.join(ROOT_DIR, 'app')]
+os.environ.setdefault('TOKEN', '123456789:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+os.environ.setdefault('HOST_URL', 'https://example.com')
+
+from app import main  # noqa: E402
+
+BATCH_SIZE = 1000
+
+
+async def set_my_commands_stub(*args, **kwargs):
+    return True
+
+
+def make_update(update_id: int) -> dict:
+    """Creating a text message update that no handler accepts, so the filters of every message handler are checked
+
+    :param update_id: update id
+    :return: update dict
+    """
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': update_id % 100 + 1, 'type': 'private'},
+            'from': {'id': update_id % 100 + 1, 'is_bot': False, 'first_name': 'Bench'},
+            'text': 'benchmark',
+        },
+    }
+
+
+async def run(updates: int):
+    """Posting updates to the webhook and printing the mean latency of every batch
+
+    :param updates: number of updates
+    :return:
+    """
+    main.bot.set_my_commands = set_my_commands_stub
+    await main.bot_main()
+
+    started = batch_start = time.perf_counter()
+    for update_id in range(1, updates + 1):
+        await main.bot_webhook(make_update(update_id))
+        if update_id % BATCH_SIZE == 0:
+            elapsed = time.perf_counter() - batch_start
+            handlers = len(main.dp.message_handlers.handlers)
+            print(f'updates {update_id - BATCH_SIZE + 1:>6}-{update_id:<6} '
+                  f'mean latency: {elapsed / BATCH_SIZE * 1e6:8.1f} us  message handlers: {handlers}')
+            batch_start = time.perf_counter()
+
+    await main.update_queue.close()
+    print(f'{updates} updates queued and processed in {time.perf_counter() - started:.2f} s')
+
+
+if __name__ == '__main__':
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000))
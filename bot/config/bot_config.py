@@ -1,14 +1,17 @@
 import os
 from functools import wraps
 
-from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram import Dispatcher, types
 from aiogram.dispatcher import FSMContext
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from cachetools import TTLCache
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, InputFile, InputMediaPhoto
+from aiogram.utils.exceptions import BadRequest, MessageNotModified
 from dotenv import load_dotenv
 
-from database.db_middleware import check_user_by_tg_id, check_is_admin_by_tg_id
+from config.middlewares import resolve_user
+from config.rate_limit import create_rate_limiter, rate_limit_rejections
+from config.send_queue import QueuedBot
+from config.storage import create_storage
+from database.db_async import get_photo_by_id, get_photo_file_id, set_photo_file_id, clear_photo_file_id
 from settings import setup_logger
 
 logger = setup_logger('bot')
@@ -17,34 +20,34 @@ load_dotenv(dotenv_path=fr'bot/config/.env')
 ADMIN_ID = os.getenv('ADMIN_ID')
 TOKEN = os.getenv('TOKEN')
 
-bot = Bot(token=TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+bot = QueuedBot(token=TOKEN)
+dp = Dispatcher(bot, storage=create_storage())
 
 
 def antispam(rate: int, interval: int, mess: str = "Слишком много запросов"):
     """A decorator that checks if the user has exceeded the request limit in a given amount of time.
+    Every decorated handler has its own token bucket per user, see config.rate_limit
     :param rate: request limit
     :param interval: time interval in seconds
     :param mess: message sent to the user if they have exceeded the request limit
     """
 
-    cache = TTLCache(maxsize=rate, ttl=interval)
-
     def decorator(func):
+        handler = f'{func.__module__}.{func.__qualname__}'
+        limiter = create_rate_limiter(rate, interval, prefix=handler)
+
         @wraps(func)
         async def wrapped(message: types.Message, state: FSMContext, *args, **kwargs):
             user_id = message.from_user.id
 
-            if user_id in cache:
-                if cache[user_id] >= rate:
-                    await message.reply(mess)
-                    return
-                cache[user_id] += 1
-            else:
-                cache[user_id] = 1
+            if not await limiter.hit(user_id):
+                rate_limit_rejections.inc(handler=handler)
+                await message.reply(mess)
+                return
 
             return await func(message, state, *args, **kwargs)
 
+        wrapped.limiter = limiter
         return wrapped
 
     return decorator
@@ -61,7 +64,7 @@ def check_user_exists():
         async def wrapped(message: types.Message, state: FSMContext, *args, **kwargs):
             user_id = message.from_user.id
 
-            if not check_user_by_tg_id(tg_id=user_id):
+            if not await resolve_user(user_id):
                 keyboard = InlineKeyboardMarkup(resize_keyboard=True)
                 keyboard.row(InlineKeyboardButton(
                     'Регистрация',
@@ -91,7 +94,8 @@ def check_user_is_admin():
         async def wrapped(message: types.Message, state: FSMContext, *args, **kwargs):
             user_id = message.from_user.id
 
-            if not check_is_admin_by_tg_id(tg_id=user_id):
+            user = await resolve_user(user_id)
+            if not user or not user.is_admin:
                 return
 
             return await func(message, state, *args, **kwargs)
@@ -166,3 +170,58 @@ async def remove_keyboard(chat_id, message_id):
     :return:
     """
     await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
+
+
+async def send_product_photo(chat_id: int, product_id: int, **kwargs) -> types.Message:
+    """Sending a product photo. The photo is uploaded only once,
+    after that it is sent by the Telegram file_id saved from the first upload
+
+    :param chat_id: chat id
+    :param product_id: product id
+    :param kwargs: other send_photo parameters (caption, reply_markup)
+    :return: sent message
+    """
+    file_id = await get_photo_file_id(product_id)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, photo=file_id, **kwargs)
+        except BadRequest as ex:
+            logger.warning(f'Cached photo of product id:<{product_id}> was rejected: {repr(ex)}')
+            await clear_photo_file_id(product_id)
+
+    photo = InputFile(await get_photo_by_id(product_id), filename=f'{product_id}.jpg')
+    message = await bot.send_photo(chat_id, photo=photo, **kwargs)
+
+    await set_photo_file_id(product_id, message.photo[-1].file_id)
+    return message
+
+
+async def edit_product_photo(chat_id: int, message_id: int, product_id: int, caption: str,
+                             reply_markup: InlineKeyboardMarkup = None) -> types.Message:
+    """Replacing the photo, caption and keyboard of a sent message with a product photo.
+    Like send_product_photo, the photo is uploaded only once
+
+    :param chat_id: chat id
+    :param message_id: message id
+    :param product_id: product id
+    :param caption: new caption
+    :param reply_markup: new keyboard
+    :return: edited message
+    """
+    file_id = await get_photo_file_id(product_id)
+    if file_id:
+        try:
+            return await bot.edit_message_media(InputMediaPhoto(file_id, caption=caption), chat_id, message_id,
+                                                reply_markup=reply_markup)
+        except MessageNotModified:
+            raise
+        except BadRequest as ex:
+            logger.warning(f'Cached photo of product id:<{product_id}> was rejected: {repr(ex)}')
+            await clear_photo_file_id(product_id)
+
+    photo = InputFile(await get_photo_by_id(product_id), filename=f'{product_id}.jpg')
+    message = await bot.edit_message_media(InputMediaPhoto(photo, caption=caption), chat_id, message_id,
+                                           reply_markup=reply_markup)
+
+    await set_photo_file_id(product_id, message.photo[-1].file_id)
+    return message
@@ -0,0 +1,95 @@
+import time
+from contextvars import ContextVar
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from database.db_async import get_user_context
+from database.db_middleware import UserContext
+from database.profiler import current_profile
+from metrics import Histogram
+
+# (Telegram id, UserContext or None) of the user who sent the update being processed
+current_user: ContextVar[tuple[int, UserContext | None]] = ContextVar('current_user')
+
+handler_duration = Histogram('bot_handler_duration_seconds',
+                             'Duration of processing updates by handlers, including middlewares and filters',
+                             ('handler',))
+
+
+async def resolve_user(tg_id: int) -> UserContext | None:
+    """Getting the user of the current update.
+    The user resolved by UserContextMiddleware is reused, so handlers and decorators don't query the database again
+
+    :param tg_id: Telegram id
+    :return: UserContext or None if the user is not registered
+    """
+    resolved = current_user.get(None)
+    if resolved and resolved[0] == tg_id:
+        return resolved[1]
+    return await load_user(tg_id)
+
+
+async def load_user(tg_id: int) -> UserContext | None:
+    """Getting the user without reusing the one resolved for the update.
+    Called for every new update and by handlers after they change the user
+
+    :param tg_id: Telegram id
+    :return: UserContext or None if the user is not registered
+    """
+    user = await get_user_context(tg_id)
+    current_user.set((tg_id, user))
+    return user
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Resolving the Telegram user once per update.
+    The user is available to handlers as the user_context argument and through resolve_user"""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data['user_context'] = await load_user(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['user_context'] = await load_user(callback_query.from_user.id)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Measuring how long updates are processed, per handler.
+    Updates that no handler accepted are measured as unhandled, SQL profiles are named after the handler"""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self.start(data)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self.set_handler(data)
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self.observe(data)
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self.start(data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self.set_handler(data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results: list, data: dict):
+        self.observe(data)
+
+    @staticmethod
+    def start(data: dict):
+        data['metrics_started'] = time.perf_counter()
+
+    @staticmethod
+    def set_handler(data: dict):
+        handler = current_handler.get()
+        data['metrics_handler'] = f'{handler.__module__}.{handler.__qualname__}'
+        profile = current_profile.get()
+        if profile is not None:
+            profile.name = data['metrics_handler']
+
+    @staticmethod
+    def observe(data: dict):
+        if 'metrics_started' in data:
+            handler_duration.observe(time.perf_counter() - data['metrics_started'],
+                                     handler=data.get('metrics_handler', 'unhandled'))
@@ -0,0 +1,99 @@
+import os
+import time
+from collections import OrderedDict
+
+from database.db_async import rate_limit_hit, remove_expired_rate_limits
+from metrics import Counter
+
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+
+rate_limit_rejections = Counter('bot_rate_limit_rejections_total', 'Updates rejected by antispam', ('handler',))
+
+
+class MemoryRateLimiter:
+    """Token bucket per key kept in the process memory.
+    A bucket holds rate tokens and is refilled at rate / interval tokens per second.
+    Buckets that have not been used for interval seconds are full again, so they are removed
+    while handling later requests: memory is O(1) per active user and no timer is needed"""
+
+    def __init__(self, rate: int, interval: float):
+        self.rate = rate
+        self.interval = interval
+        # key: (tokens, last update time), ordered from the least recently used
+        self.buckets: OrderedDict[object, tuple[float, float]] = OrderedDict()
+
+    def expire(self, now: float):
+        """Removing the buckets that have not been used for interval seconds
+
+        :param now: current monotonic time
+        :return:
+        """
+        while self.buckets:
+            key, (tokens, updated) = next(iter(self.buckets.items()))
+            if now - updated < self.interval:
+                return
+            del self.buckets[key]
+
+    async def hit(self, key) -> bool:
+        """Taking a token from the key's bucket
+
+        :param key: user id
+        :return: True if the request is allowed
+        """
+        now = time.monotonic()
+        self.expire(now)
+
+        tokens, updated = self.buckets.pop(key, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - updated) * self.rate / self.interval)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+
+        return allowed
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+class SQLiteRateLimiter:
+    """Token bucket per key kept in the rate_limits table, shared by all workers using the database.
+    Expired buckets are removed at most once per interval"""
+
+    def __init__(self, rate: int, interval: float, prefix: str = ''):
+        self.rate = rate
+        self.interval = interval
+        self.prefix = prefix
+        self.last_expire = time.monotonic()
+
+    async def hit(self, key) -> bool:
+        """Taking a token from the key's bucket.
+        Requests are allowed if the database is not available
+
+        :param key: user id
+        :return: True if the request is allowed
+        """
+        now = time.monotonic()
+        if now - self.last_expire >= self.interval:
+            self.last_expire = now
+            await remove_expired_rate_limits(self.interval, self.prefix)
+
+        allowed = await rate_limit_hit(f'{self.prefix}:{key}', self.rate, self.interval)
+        return allowed is not False
+
+
+def create_rate_limiter(rate: int, interval: float, prefix: str = '',
+                        backend: str = RATE_LIMIT_BACKEND) -> MemoryRateLimiter | SQLiteRateLimiter:
+    """Creating a rate limiter
+
+    :param rate: request limit
+    :param interval: time interval in seconds
+    :param prefix: key prefix separating limiters that share the database
+    :param backend: memory or sqlite
+    :return: rate limiter
+    """
+    if backend == 'sqlite':
+        return SQLiteRateLimiter(rate, interval, prefix)
+    if backend == 'memory':
+        return MemoryRateLimiter(rate, interval)
+    raise ValueError(f'Unknown rate limit backend <{backend}>')
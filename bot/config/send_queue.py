@@ -0,0 +1,198 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+from metrics import Counter, Gauge, Histogram
+from settings import setup_logger
+
+logger = setup_logger('bot')
+
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))  # requests per second for all chats
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))  # requests per second for a private chat
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))  # requests a private chat can get at once
+SEND_GROUP_RATE = 20 / 60  # requests per second for a group chat
+SEND_RETRIES = int(os.getenv('SEND_RETRIES', 3))  # retries after flood control errors
+
+# methods that post to a chat and count towards Telegram flood limits
+QUEUED_METHODS_PREFIXES = ('send', 'edit', 'delete', 'forward', 'copy')
+# edits of the same message that replace each other, only the last one of a row is sent
+COALESCED_METHODS = {'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup'}
+
+telegram_request_duration = Histogram('telegram_request_duration_seconds', 'Duration of Telegram API requests',
+                                      ('method',))
+telegram_request_errors = Counter('telegram_request_errors_total', 'Failed Telegram API requests',
+                                  ('method', 'error'))
+telegram_queue_depth = Gauge('telegram_send_queue_depth', 'Telegram requests waiting in the send queue')
+
+
+class TokenBucket:
+    """Token bucket that tells how long to wait for a token instead of rejecting"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Taking a token, it can be borrowed from the future
+
+        :return: seconds to wait before using the token
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def is_full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+@dataclass
+class Job:
+    method: str
+    data: dict
+    files: dict | None
+    kwargs: dict
+    futures: list[asyncio.Future] = field(default_factory=list)
+
+    def message_key(self) -> tuple | None:
+        if self.method in COALESCED_METHODS and self.data.get('message_id'):
+            return self.method, self.data['message_id']
+
+
+class SendQueue:
+    """Outbound Telegram requests of all chats.
+    Every chat has its own queue and worker: requests of a chat are sent in order,
+    different chats are served concurrently. Requests wait for the global and the chat token bucket,
+    requests rejected by flood control are retried after the time given by Telegram"""
+
+    def __init__(self, send, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: int = SEND_CHAT_BURST, retries: int = SEND_RETRIES):
+        self.send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        # chat id: bucket, ordered from the least recently used, full buckets are removed
+        self.chat_buckets: OrderedDict[object, TokenBucket] = OrderedDict()
+        self.queues: dict[object, deque[Job]] = {}
+        self.workers: dict[object, asyncio.Task] = {}
+
+    async def put(self, chat_id, method: str, data: dict, files: dict | None = None, **kwargs):
+        """Queueing a request and waiting for its result.
+        An edit of a message replaces a queued edit of the same message made by the same method
+
+        :param chat_id: chat id
+        :param method: API method
+        :param data: request parameters
+        :param files: files
+        :return: API result
+        """
+        future = asyncio.get_running_loop().create_future()
+        job = Job(method, data, files, kwargs, [future])
+
+        queue = self.queues.setdefault(chat_id, deque())
+        if queue and job.message_key() and queue[-1].message_key() == job.message_key():
+            job.futures = queue.pop().futures + job.futures
+        queue.append(job)
+
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self.work(chat_id))
+        return await future
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        while self.chat_buckets:
+            oldest_id, oldest = next(iter(self.chat_buckets.items()))
+            if oldest_id in self.queues or not oldest.is_full():
+                break
+            del self.chat_buckets[oldest_id]
+
+        bucket = self.chat_buckets.pop(chat_id, None)
+        if bucket is None:
+            is_group = str(chat_id).startswith('-')
+            bucket = TokenBucket(SEND_GROUP_RATE, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+        self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def work(self, chat_id):
+        queue = self.queues[chat_id]
+        try:
+            while queue:
+                job = queue.popleft()
+                try:
+                    result = await self.execute(chat_id, job)
+                except Exception as ex:
+                    for future in job.futures:
+                        if not future.done():
+                            future.set_exception(ex)
+                else:
+                    for future in job.futures:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            del self.queues[chat_id]
+            del self.workers[chat_id]
+
+    async def execute(self, chat_id, job: Job):
+        for attempt in range(self.retries + 1):
+            await asyncio.sleep(max(self.chat_bucket(chat_id).take(), self.global_bucket.take()))
+            rewind(job.files)
+            try:
+                return await self.send(job.method, job.data, job.files, **job.kwargs)
+            except RetryAfter as ex:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f'Flood control for chat <{chat_id}>, retrying <{job.method}> in {ex.timeout} s')
+                await asyncio.sleep(ex.timeout)
+
+    async def close(self, timeout: float = 10):
+        """Waiting for queued requests to be sent
+
+        :param timeout: seconds to wait
+        :return:
+        """
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()), timeout=timeout)
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+
+def rewind(files: dict | None):
+    """Rewinding uploaded files before a retry"""
+    for file in (files or {}).values():
+        stream = getattr(file, 'file', file)
+        if hasattr(stream, 'seek'):
+            stream.seek(0)
+
+
+class QueuedBot(Bot):
+    """Bot sending messages, edits and deletions through SendQueue.
+    Other requests, like answerCallbackQuery or setWebhook, are made directly.
+    Durations and errors of the API requests are collected in metrics"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send_queue = SendQueue(self.send_request)
+        telegram_queue_depth.set_function(self.send_queue.depth)
+
+    async def send_request(self, method: str, data: dict | None = None, files: dict | None = None, **kwargs):
+        with telegram_request_duration.time(method=method):
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except Exception as ex:
+                telegram_request_errors.inc(method=method, error=type(ex).__name__)
+                raise
+
+    async def request(self, method: str, data: dict | None = None, files: dict | None = None, **kwargs):
+        chat_id = (data or {}).get('chat_id')
+        if chat_id is None or not method.startswith(QUEUED_METHODS_PREFIXES):
+            return await self.send_request(method, data, files, **kwargs)
+        return await self.send_queue.put(chat_id, method, data, files, **kwargs)
@@ -0,0 +1,212 @@
+import asyncio
+import copy
+import os
+import time
+import typing
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+
+from database.db_async import get_fsm_record, save_fsm_records, remove_expired_fsm_records
+from settings import setup_logger
+
+logger = setup_logger('bot')
+
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+FSM_FLUSH_DELAY = float(os.getenv('FSM_FLUSH_DELAY', 0.1))
+FSM_TTL = int(os.getenv('FSM_TTL', 86400))
+FSM_SAVE_ATTEMPTS = 3  # flushes a record is tried in before it is dropped
+
+Address = tuple[str, str]
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM storage in the fsm_records table, shared by all workers using the database and kept across restarts.
+    Changes are collected for flush_delay seconds and written in one transaction,
+    until then they are served from memory. Conversations not updated for ttl seconds are dropped.
+    When the transaction fails, records are saved one by one, a record that can't be saved
+    in FSM_SAVE_ATTEMPTS flushes is dropped, so it doesn't block the others"""
+
+    def __init__(self, flush_delay: float = FSM_FLUSH_DELAY, ttl: float = FSM_TTL):
+        self.flush_delay = flush_delay
+        self.ttl = ttl
+        self.pending: dict[Address, dict] = {}
+        self.flushing: dict[Address, dict] = {}
+        self.flush_task: asyncio.Task | None = None
+        self.last_expire = 0.0
+        self.failed_attempts: dict[Address, int] = {}
+
+    def resolve_address(self, chat, user) -> Address:
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    async def load(self, address: Address) -> dict:
+        """Getting a record: not saved changes first, then the database
+
+        :param address: (chat, user)
+        :return: {'state': ..., 'data': ..., 'bucket': ...}, not a copy for pending records
+        """
+        if address in self.pending:
+            return self.pending[address]
+        if address in self.flushing:
+            return copy.deepcopy(self.flushing[address])
+
+        row = await get_fsm_record(*address, self.ttl)
+        if address in self.pending:  # changed while the database was queried
+            return self.pending[address]
+        if row is None:
+            return {'state': None, 'data': {}, 'bucket': {}}
+        state, data, bucket = row
+        return {'state': state, 'data': data or {}, 'bucket': bucket or {}}
+
+    async def edit(self, address: Address) -> dict:
+        """Getting a record for changing, it is saved with the next flush
+
+        :param address: (chat, user)
+        :return: pending record
+        """
+        record = await self.load(address)
+        self.pending[address] = record
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+        return record
+
+    async def flush_later(self):
+        await asyncio.sleep(self.flush_delay)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """Writing pending records to the database and removing abandoned conversations
+
+        :return:
+        """
+        records, self.pending = self.pending, {}
+        self.flushing.update(records)
+        try:
+            failed = await self.save(records)
+        finally:
+            for address in records:
+                if self.flushing.get(address) is records[address]:
+                    del self.flushing[address]
+
+        for address in records:
+            if address not in failed:
+                self.failed_attempts.pop(address, None)
+        for address, record in failed.items():
+            self.failed_attempts[address] = self.failed_attempts.get(address, 0) + 1
+            if self.failed_attempts[address] >= FSM_SAVE_ATTEMPTS:
+                logger.error(f'FSM record <{address}> not saved in {FSM_SAVE_ATTEMPTS} attempts, dropped')
+                del self.failed_attempts[address]
+            else:
+                self.pending.setdefault(address, record)
+        if failed:
+            logger.error(f'{len(failed)} FSM records not saved')
+        if self.pending and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+        now = time.monotonic()
+        if now - self.last_expire >= min(self.ttl, 3600):
+            self.last_expire = now
+            removed = await remove_expired_fsm_records(self.ttl)
+            if removed:
+                logger.info(f'{removed} abandoned FSM records removed')
+
+    @staticmethod
+    async def save(records: dict[Address, dict]) -> dict[Address, dict]:
+        """Saving records in one transaction, or one by one if it fails
+
+        :param records: (chat, user): record
+        :return: records not saved
+        """
+        if not records or await save_fsm_records(copy.deepcopy(records)):
+            return {}
+        if len(records) == 1:
+            return records
+        return {address: record for address, record in records.items()
+                if not await save_fsm_records({address: copy.deepcopy(record)})}
+
+    async def close(self):
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        for _ in range(FSM_SAVE_ATTEMPTS):
+            await self.flush()
+            if not self.pending:
+                break
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self.load(self.resolve_address(chat, user))
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self.load(self.resolve_address(chat, user))
+        return copy.deepcopy(record['data'] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        record = await self.edit(self.resolve_address(chat, user))
+        record['state'] = self.resolve_state(state)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        record = await self.edit(self.resolve_address(chat, user))
+        record['data'] = copy.deepcopy(data or {})
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        record = await self.edit(self.resolve_address(chat, user))
+        record['data'] = {**record['data'], **(data or {}), **kwargs}
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self.load(self.resolve_address(chat, user))
+        return copy.deepcopy(record['bucket'] or default or {})
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        record = await self.edit(self.resolve_address(chat, user))
+        record['bucket'] = copy.deepcopy(bucket or {})
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        record = await self.edit(self.resolve_address(chat, user))
+        record['bucket'] = {**record['bucket'], **(bucket or {}), **kwargs}
+
+
+def create_storage(backend: str = FSM_STORAGE) -> BaseStorage:
+    """Creating the dispatcher FSM storage
+
+    :param backend: sqlite or memory
+    :return: storage
+    """
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'Unknown FSM storage <{backend}>')
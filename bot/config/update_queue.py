@@ -0,0 +1,130 @@
+import asyncio
+import contextvars
+import os
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable
+
+from aiogram import types
+
+from settings import setup_logger
+
+logger = setup_logger('bot')
+
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 8))  # updates processed at once
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000))  # updates waiting before the webhook is refused
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv('WEBHOOK_QUEUE_TIMEOUT', 5))  # seconds to wait for room in the queue
+RECENT_UPDATES_SIZE = 1000  # update ids remembered to drop updates delivered again by Telegram
+
+
+def update_chat_id(update: types.Update) -> int:
+    """Getting the chat of an update, updates of a chat are processed in order.
+    Updates without a chat, like inline queries, are ordered by the user
+
+    :param update: Telegram update
+    :return: chat id, user id or update id
+    """
+    callback_query = update.callback_query
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post \
+        or (callback_query.message if callback_query else None)
+    if message:
+        return message.chat.id
+    for value in update.values.values():
+        user = getattr(value, 'from_user', None)
+        if user:
+            return user.id
+    return update.update_id
+
+
+class UpdateQueue:
+    """Incoming Telegram updates waiting to be processed.
+    The webhook only queues an update, a pool of workers processes them. Updates of a chat wait in the chat's queue
+    and are processed one by one by one worker, different chats are processed concurrently.
+    When the queue is full, queueing waits for room and then gives up, so Telegram retries the update later"""
+
+    def __init__(self, process: Callable[[types.Update], Awaitable], workers: int = WEBHOOK_WORKERS,
+                 size: int = WEBHOOK_QUEUE_SIZE, timeout: float = WEBHOOK_QUEUE_TIMEOUT):
+        self.process = process
+        self.workers_number = workers
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(size)
+        # chat id: updates, a chat is here from its first queued update until its last one is processed
+        self.chats: dict[int, deque[types.Update]] = {}
+        self.ready: asyncio.Queue[int] | None = None
+        self.workers: list[asyncio.Task] = []
+        self.recent_updates: OrderedDict[int, None] = OrderedDict()
+        self.closing = False
+
+    async def put(self, update: types.Update) -> bool:
+        """Queueing an update
+
+        :param update: Telegram update
+        :return: False if the queue is full or closed and the update should be delivered again
+        """
+        if self.closing:
+            return False
+        if update.update_id in self.recent_updates:
+            logger.warning(f'Update <{update.update_id}> is already received')
+            return True
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f'Update <{update.update_id}> refused, the queue is full')
+            return False
+        if self.closing:
+            self.slots.release()
+            return False
+
+        self.recent_updates[update.update_id] = None
+        if len(self.recent_updates) > RECENT_UPDATES_SIZE:
+            self.recent_updates.popitem(last=False)
+
+        self.start()
+        chat_id = update_chat_id(update)
+        if chat_id not in self.chats:
+            self.chats[chat_id] = deque()
+            self.ready.put_nowait(chat_id)
+        self.chats[chat_id].append(update)
+        return True
+
+    def start(self):
+        if self.workers:
+            return
+        self.ready = asyncio.Queue()
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.workers_number)]
+
+    async def work(self):
+        while True:
+            chat_id = await self.ready.get()
+            updates = self.chats[chat_id]
+            while updates:
+                update = updates.popleft()
+                try:
+                    # every update gets an empty context, context variables set for an update,
+                    # like the resolved user, don't leak into the next one or from the request that queued it
+                    await asyncio.create_task(self.process(update), context=contextvars.Context())
+                except Exception as ex:
+                    logger.error(f'Update <{update.update_id}> not processed: {repr(ex)}')
+                finally:
+                    self.slots.release()
+            del self.chats[chat_id]
+            self.ready.task_done()
+
+    def depth(self) -> int:
+        return sum(len(updates) for updates in self.chats.values())
+
+    async def close(self, timeout: float = 30):
+        """Refusing new updates, processing queued ones and stopping the workers
+
+        :param timeout: seconds to wait for queued updates
+        :return:
+        """
+        self.closing = True
+        if self.ready is not None:
+            try:
+                await asyncio.wait_for(self.ready.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.error(f'{self.depth()} updates not processed before shutdown')
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
@@ -1,5 +1,3 @@
-import datetime
-
 from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import StatesGroup, State
@@ -7,7 +5,8 @@ from aiogram.types import ReplyKeyboardRemove
 from aiogram.utils.callback_data import CallbackData
 
 from config.bot_config import bot, create_inline_keyboard
-from database.db_middleware import get_user_id_by_tg_id, get_name_by_id, add_order
+from config.middlewares import resolve_user
+from database.db_async import get_name_by_id, add_to_cart
 from database.models import Product
 from handlers.get_menu.get_menu import new_order_callback
 
@@ -26,7 +25,8 @@ async def start_ordering(callback_query: types.CallbackQuery, state: FSMContext,
     product_id = callback_data.get('product_id')
     price = float(callback_data.get('price'))
 
-    user_id = get_user_id_by_tg_id(callback_query.from_user.id)
+    user = await resolve_user(callback_query.from_user.id)
+    user_id = user.id if user else None
 
     await state.update_data(product_id=product_id, user_id=user_id, price=price)
 
@@ -56,7 +56,7 @@ async def get_quantity(message: types.Message, state: FSMContext):
     keyboard = create_inline_keyboard(**buttons)
 
     await message.answer(f'Проверьте правильность введенных данных:\n'
-                         f'Наименование товара: {get_name_by_id(Product, product_id)}\n'
+                         f'Наименование товара: {await get_name_by_id(Product, product_id)}\n'
                          f'Количество: {quantity}\n'
                          f'Стоимость: {price * quantity} руб.',
                          reply_markup=keyboard)
@@ -72,8 +72,10 @@ async def get_confirm(callback_query: types.CallbackQuery, state: FSMContext, ca
 
     answer = callback_data.get('answer')
     if answer == 'yes':
-        add_order(user=user_id, order_time=datetime.datetime.now(), product=product_id, quantity=quantity)
-        await callback_query.answer('Заказ добавлен в корзину', show_alert=True)
+        if await add_to_cart(user_id, [(product_id, quantity)]):
+            await callback_query.answer('Заказ добавлен в корзину', show_alert=True)
+        else:
+            await callback_query.answer('Что-то пошло не так :(', show_alert=True)
     else:
         await callback_query.answer('Заказ отменен', show_alert=True)
 
@@ -1,5 +1,4 @@
-import os
-import tempfile
+import io
 
 from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
@@ -8,7 +7,7 @@ from aiogram.types import ReplyKeyboardRemove
 
 from config.bot_config import bot, check_user_is_admin
 from config.static_buttons import CANCEL_BUTTON
-from database.db_middleware import add_product
+from database.db_async import add_product_from_tg
 
 
 class AddProductStates(StatesGroup):
@@ -55,13 +54,12 @@ async def get_photo(message: types.Message, state: FSMContext):
         product_name = data.get('product_name')
         product_price = data.get('price')
 
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
-        await photo.download(destination=temp_file.name)
-        photo_path = temp_file.name
+        photo_file = io.BytesIO()
+        await photo.download(destination_file=photo_file)
 
-        add_product(name=product_name, price=product_price, photo_path=photo_path, is_available=True)
+        await add_product_from_tg(name=product_name, price=product_price, photo=photo_file.getvalue(),
+                                  is_available=True)
 
-        os.remove(photo_path)
         await message.answer('Продукт успешно добавлен', reply_markup=ReplyKeyboardRemove())
 
         await state.finish()
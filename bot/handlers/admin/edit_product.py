@@ -3,8 +3,8 @@ from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import StatesGroup
 from aiogram.utils.callback_data import CallbackData
 
-from config.bot_config import bot, create_inline_keyboard, check_user_is_admin
-from database.db_middleware import get_all_values, get_photo_by_id, change_product_is_available, get_name_by_id, \
+from config.bot_config import bot, create_inline_keyboard, check_user_is_admin, send_product_photo
+from database.db_async import get_product_summaries, change_product_is_available, get_name_by_id, \
     get_object_by_id, delete_product_by_id
 from database.models import Product
 
@@ -18,7 +18,7 @@ async def start_edit(callback_query: types.CallbackQuery, state: FSMContext):
     await state.finish()
     await callback_query.answer()
 
-    products = get_all_values(Product)
+    products = await get_product_summaries(only_available=False)
     for product in products:
         if product.is_available:
             buttons = {
@@ -33,8 +33,7 @@ async def start_edit(callback_query: types.CallbackQuery, state: FSMContext):
 
         keyboard = create_inline_keyboard(**buttons)
 
-        with open(get_photo_by_id(product.id), 'rb') as photo:
-            await bot.send_photo(callback_query.from_user.id, photo=photo,
+        await send_product_photo(callback_query.from_user.id, product.id,
                                  caption=f'Блюдо: {product.name}\n'
                                          f'Цена: {product.price} руб.\n',
                                  reply_markup=keyboard)
@@ -45,8 +44,8 @@ async def stopping_product(callback_query: types.CallbackQuery, state: FSMContex
     await state.finish()
 
     product_id = int(callback_data.get('product_id'))
-    change_product_is_available(product_id=product_id, is_available=False)
-    product = get_object_by_id(Product, product_id)
+    await change_product_is_available(product_id=product_id, is_available=False)
+    product = await get_object_by_id(Product, product_id)
 
     await callback_query.answer(f'{product.name} поставлен на стоп', show_alert=True)
 
@@ -59,8 +58,7 @@ async def stopping_product(callback_query: types.CallbackQuery, state: FSMContex
     }
     keyboard = create_inline_keyboard(**buttons)
 
-    with open(get_photo_by_id(product.id), 'rb') as photo:
-        await bot.send_photo(callback_query.from_user.id, photo=photo,
+    await send_product_photo(callback_query.from_user.id, product.id,
                              caption=f'Блюдо: {product.name}\n'
                                      f'Цена: {product.price} руб.\n',
                              reply_markup=keyboard)
@@ -71,8 +69,8 @@ async def starting_product(callback_query: types.CallbackQuery, state: FSMContex
     await state.finish()
 
     product_id = int(callback_data.get('product_id'))
-    change_product_is_available(product_id=product_id, is_available=True)
-    product = get_object_by_id(Product, product_id)
+    await change_product_is_available(product_id=product_id, is_available=True)
+    product = await get_object_by_id(Product, product_id)
 
     await callback_query.answer(f'{product.name} активен', show_alert=True)
 
@@ -85,8 +83,7 @@ async def starting_product(callback_query: types.CallbackQuery, state: FSMContex
     }
     keyboard = create_inline_keyboard(**buttons)
 
-    with open(get_photo_by_id(product.id), 'rb') as photo:
-        await bot.send_photo(callback_query.from_user.id, photo=photo,
+    await send_product_photo(callback_query.from_user.id, product.id,
                              caption=f'Блюдо: {product.name}\n'
                                      f'Цена: {product.price} руб.\n',
                              reply_markup=keyboard)
@@ -97,9 +94,14 @@ async def deleting_product(callback_query: types.CallbackQuery, state: FSMContex
     await state.finish()
 
     product_id = int(callback_data.get('product_id'))
-    delete_product_by_id(Product, product_id)
-
-    await callback_query.answer(f'Продукт удален', show_alert=True)
+    deleted = await delete_product_by_id(Product, product_id)
+
+    if deleted:
+        await callback_query.answer(f'Продукт удален', show_alert=True)
+    elif deleted is False:
+        await callback_query.answer('Продукт есть в заказах, поэтому он скрыт из меню, а не удален', show_alert=True)
+    else:
+        await callback_query.answer('Не удалось удалить продукт', show_alert=True)
 
     message_id = callback_query.message.message_id
     await bot.delete_message(callback_query.from_user.id, message_id)
@@ -4,7 +4,8 @@ from aiogram.dispatcher.filters.state import StatesGroup, State
 from aiogram.types import ReplyKeyboardRemove
 
 from config.bot_config import bot, get_start_kb_not_authorized, get_start_kb_authorized
-from database.db_middleware import check_user_by_name_and_password, check_user_by_tg_id, set_tg_id
+from config.middlewares import load_user, resolve_user
+from database.db_async import check_user_by_name_and_password, set_tg_id
 from config.static_buttons import CANCEL_BUTTON
 
 
@@ -15,7 +16,7 @@ class AuthorizationStates(StatesGroup):
 
 async def start_authorization(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
-    if check_user_by_tg_id(tg_id=callback_query.from_user.id):
+    if await resolve_user(callback_query.from_user.id):
         keyboard = get_start_kb_authorized()
         await bot.send_message(callback_query.from_user.id,
                                'Привет, я бот, который поможет тебе сделать заказ из твоего любимого ресторана',
@@ -41,8 +42,9 @@ async def get_password(message: types.Message, state: FSMContext):
     username = data.get('username')
     password = message.text
 
-    if check_user_by_name_and_password(name=username, password=password):
-        set_tg_id(username=username, tg_id=message.from_user.id)
+    if await check_user_by_name_and_password(name=username, password=password):
+        await set_tg_id(username=username, tg_id=message.from_user.id)
+        await load_user(message.from_user.id)
         keyboard = get_start_kb_authorized()
         await bot.send_message(message.from_user.id,
                                'Привет, я бот, который поможет тебе сделать заказ из твоего любимого ресторана',
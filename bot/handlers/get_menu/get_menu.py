@@ -1,28 +1,65 @@
 from aiogram import types, Dispatcher
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.callback_data import CallbackData
+from aiogram.utils.exceptions import MessageNotModified
 
-from config.bot_config import bot, create_inline_keyboard
-from database.db_middleware import get_all_values, \
-    get_photo_by_id
-from database.models import Product
+from config.bot_config import send_product_photo, edit_product_photo
+from database.db_async import get_menu_page
+from database.db_middleware import MenuPage
 
 new_order_callback = CallbackData('new_order_callback', 'product_id', 'price')
+menu_page_callback = CallbackData('menu_page_callback', 'product_id', 'direction')
+
+
+def render_menu_page(page: MenuPage) -> tuple[str, InlineKeyboardMarkup]:
+    """Creating the caption and keyboard of a menu page
+
+    :param page: MenuPage
+    :return: caption and keyboard
+    """
+    product = page.product
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton(
+        'Заказать',
+        callback_data=new_order_callback.new(product_id=product.id, price=product.price)))
+
+    navigation = []
+    if page.has_previous:
+        navigation.append(InlineKeyboardButton(
+            '◀️', callback_data=menu_page_callback.new(product_id=product.id, direction='previous')))
+    if page.has_next:
+        navigation.append(InlineKeyboardButton(
+            '▶️', callback_data=menu_page_callback.new(product_id=product.id, direction='next')))
+    if navigation:
+        keyboard.row(*navigation)
+
+    return f'Блюдо: {product.name}\nЦена: {product.price} руб.\n', keyboard
 
 
 async def get_menu(callback_query: types.CallbackQuery):
     await callback_query.answer()
-    products = get_all_values(Product)
-    for product in products:
-        if product.is_available:
-            buttons = {
-                'Заказать': new_order_callback.new(product_id=product.id, price=product.price),
-            }
-            keyboard = create_inline_keyboard(**buttons)
-            with open(get_photo_by_id(product.id), 'rb') as photo:
-                await bot.send_photo(callback_query.from_user.id, photo=photo,
-                                     caption=f'Блюдо: {product.name}\n'
-                                             f'Цена: {product.price} руб.\n',
-                                     reply_markup=keyboard)
+    page = await get_menu_page()
+    if page is None:
+        await callback_query.message.answer('Меню пока пусто')
+        return
+
+    caption, keyboard = render_menu_page(page)
+    await send_product_photo(callback_query.from_user.id, page.product.id, caption=caption, reply_markup=keyboard)
+
+
+async def turn_menu_page(callback_query: types.CallbackQuery, callback_data: dict):
+    page = await get_menu_page(int(callback_data.get('product_id')), callback_data.get('direction'))
+    if page is None:
+        await callback_query.answer('Других блюд в меню нет')
+        return
+
+    await callback_query.answer()
+    caption, keyboard = render_menu_page(page)
+    try:
+        await edit_product_photo(callback_query.from_user.id, callback_query.message.message_id, page.product.id,
+                                 caption=caption, reply_markup=keyboard)
+    except MessageNotModified:
+        pass
 
 
 def register_handlers_menu(dp: Dispatcher):
@@ -32,3 +69,4 @@ def register_handlers_menu(dp: Dispatcher):
     :return:
     """
     dp.register_callback_query_handler(get_menu, text='view_menu')
+    dp.register_callback_query_handler(turn_menu_page, menu_page_callback.filter())
@@ -5,7 +5,9 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeybo
 from aiogram.utils.callback_data import CallbackData
 
 from config.bot_config import bot, ADMIN_ID, get_start_kb_authorized, get_start_kb_not_authorized
-from database.db_middleware import add_user, check_user_by_tg_id
+from config.middlewares import load_user, resolve_user
+from database.db_async import add_user
+from database.db_middleware import hash_password
 from config.static_buttons import CANCEL_BUTTON
 
 callback_confirm = CallbackData('confirmation_user', 'answer')
@@ -21,7 +23,7 @@ class RegistrationStates(StatesGroup):
 
 async def start_registration(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
-    if check_user_by_tg_id(tg_id=callback_query.from_user.id):
+    if await resolve_user(callback_query.from_user.id):
         await bot.send_message(callback_query.from_user.id, 'Вы уже зарегистрированы')
         await state.finish()
         return
@@ -39,7 +41,8 @@ async def get_username(message: types.Message, state: FSMContext):
 
 async def get_password(message: types.Message, state: FSMContext):
     await bot.delete_message(message.from_user.id, message.message_id)
-    await state.update_data(password=message.text)
+    # conversations are kept in the database, so only the hash of the password is stored
+    await state.update_data(password_hash=hash_password(message.text))
     await message.answer('Введите адрес доставки', reply_markup=CANCEL_BUTTON)
     await state.set_state(RegistrationStates.get_address.state)
 
@@ -55,7 +58,6 @@ async def confirmation(message: types.Message, state: FSMContext):
 
     data = await state.get_data()
     username = data.get('username')
-    password = data.get('password')
     address = data.get('address')
     phone_number = message.text
 
@@ -65,7 +67,7 @@ async def confirmation(message: types.Message, state: FSMContext):
 
     await message.answer(f'Всё верно?\n'
                          f'Имя пользователя: {username}\n'
-                         f'Пароль: {password}\n'
+                         f'Пароль: ********\n'
                          f'Адрес: {address}\n'
                          f'Номер телефона: {phone_number}\n',
                          reply_markup=keyboard)
@@ -77,7 +79,7 @@ async def confirm(callback_query: types.CallbackQuery, callback_data: dict, stat
         await callback_query.answer('Ваши данные успешно сохранены', show_alert=True)
         data = await state.get_data()
         username = data.get('username')
-        password = data.get('password')
+        password_hash = data.get('password_hash')
         address = data.get('address')
         phone_number = data.get('phone_number')
 
@@ -86,8 +88,9 @@ async def confirm(callback_query: types.CallbackQuery, callback_data: dict, stat
         else:
             is_admin = False
 
-        add_user(name=username, tg_id=callback_query.from_user.id, password=password, address=address,
-                 phone_number=phone_number, is_admin=is_admin)
+        await add_user(name=username, tg_id=callback_query.from_user.id, password=None, password_hash=password_hash,
+                       address=address, phone_number=phone_number, is_admin=is_admin)
+        await load_user(callback_query.from_user.id)
 
         keyboard = get_start_kb_authorized()
         await bot.send_message(callback_query.from_user.id,
@@ -1,35 +1,55 @@
+from itertools import groupby
+
 from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.callback_data import CallbackData
 
-from config.bot_config import bot, create_inline_keyboard
-from database.db_middleware import get_photo_by_id, get_user_id_by_tg_id, get_user_cart_by_id, cancel_order_by_id
+from config.bot_config import bot
+from config.middlewares import resolve_user
+from database.db_async import get_user_cart_by_id, cancel_order_by_id, remove_order_item
+from database.db_middleware import Cart
 
 cancel_order_callback = CallbackData('cancel_order_callback', 'order_id')
+remove_item_callback = CallbackData('remove_item_callback', 'order_id', 'product_id')
+
+
+def render_order(items: list[Cart]) -> tuple[str, InlineKeyboardMarkup]:
+    """Creating the cart message of an order
+
+    :param items: items of one order
+    :return: message text and keyboard
+    """
+    order_id = items[0].order_id
+    lines = [f'Заказ №{order_id}']
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for item in items:
+        lines.append(f'{item.name}: {item.quantity} шт. — {item.cash} руб.')
+        keyboard.add(InlineKeyboardButton(
+            text=f'Убрать: {item.name}',
+            callback_data=remove_item_callback.new(order_id=order_id, product_id=item.product_id)))
+    lines.append(f'Стоимость заказа: {items[0].total} руб.')
+    keyboard.add(InlineKeyboardButton(text='Отменить заказ',
+                                      callback_data=cancel_order_callback.new(order_id=order_id)))
+    return '\n'.join(lines), keyboard
 
 
 async def get_cart(callback_query: types.CallbackQuery, state: FSMContext):
     await state.finish()
     await callback_query.answer()
-    user_id = get_user_id_by_tg_id(callback_query.from_user.id)
-    orders = get_user_cart_by_id(user_id)
-    for order in orders:
-        if not order.cancelled:
-            with open(get_photo_by_id(order.photo_id), 'rb') as photo:
-                buttons = {
-                    'Отменить заказ': cancel_order_callback.new(order_id=order.order_id),
-                }
-                keyboard = create_inline_keyboard(**buttons)
-                await bot.send_photo(callback_query.from_user.id, photo=photo,
-                                     caption=f'Блюдо: {order.name}\n'
-                                             f'Количество: {order.quantity} шт.\n'
-                                             f'Стоимость заказа: {order.cash} руб.',
-                                     reply_markup=keyboard)
+    user = await resolve_user(callback_query.from_user.id)
+    items = await get_user_cart_by_id(user.id) if user else []
+    if not items:
+        await bot.send_message(callback_query.from_user.id, 'Корзина пуста')
+    for _, order_items in groupby(items, key=lambda item: item.order_id):
+        text, keyboard = render_order(list(order_items))
+        await bot.send_message(callback_query.from_user.id, text, reply_markup=keyboard)
 
 
 async def cancel_order(callback_query: types.CallbackQuery, callback_data: dict):
     order_id = int(callback_data.get('order_id'))
-    cancelling = cancel_order_by_id(order_id=order_id)
+    user = await resolve_user(callback_query.from_user.id)
+    cancelling = await cancel_order_by_id(order_id=order_id, user_id=user.id) if user else None
     if cancelling:
         await callback_query.answer('Ваш заказ отменен', show_alert=True)
     else:
@@ -38,6 +58,24 @@ async def cancel_order(callback_query: types.CallbackQuery, callback_data: dict)
     await bot.delete_message(callback_query.from_user.id, message_id)
 
 
+async def remove_item(callback_query: types.CallbackQuery, callback_data: dict):
+    order_id = int(callback_data.get('order_id'))
+    user = await resolve_user(callback_query.from_user.id)
+    if not user or not await remove_order_item(order_id=order_id, product_id=int(callback_data.get('product_id')),
+                                               user_id=user.id):
+        await callback_query.answer('Что-то пошло не так :(', show_alert=True)
+        return
+    await callback_query.answer('Блюдо убрано из заказа')
+
+    items = [item for item in await get_user_cart_by_id(user.id) if item.order_id == order_id]
+    message_id = callback_query.message.message_id
+    if items:
+        text, keyboard = render_order(items)
+        await bot.edit_message_text(text, callback_query.from_user.id, message_id, reply_markup=keyboard)
+    else:
+        await bot.delete_message(callback_query.from_user.id, message_id)
+
+
 def register_handlers_cart(dp: Dispatcher):
     """Handler registration function
 
@@ -46,3 +84,4 @@ def register_handlers_cart(dp: Dispatcher):
     """
     dp.register_callback_query_handler(get_cart, text='view_cart')
     dp.register_callback_query_handler(cancel_order, cancel_order_callback.filter())
+    dp.register_callback_query_handler(remove_item, remove_item_callback.filter())
@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from sqlalchemy import event
+
+from database import db_middleware, image_store
+from metrics import Counter, Histogram
+
+DB_WORKERS = int(os.getenv('DB_WORKERS', 4))
+
+executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='database')
+
+# name of the db_middleware function running in the current thread
+current_function: contextvars.ContextVar[str] = contextvars.ContextVar('current_function', default='other')
+
+db_function_duration = Histogram('db_function_duration_seconds',
+                                 'Duration of database functions run in the thread pool', ('function',))
+db_queries = Counter('db_queries_total', 'SQL statements executed by database functions', ('function',))
+
+
+@event.listens_for(db_middleware.engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    db_queries.inc(function=current_function.get())
+
+
+def run_in_executor(func: Callable, collect: bool = False) -> Callable:
+    """Creating an async version of a db_middleware function.
+    The function is called in the database thread pool, so the event loop is not blocked
+
+    :param func: synchronous function
+    :param collect: the function is a generator, its values are collected into a list inside the thread
+    :return: coroutine function with the same arguments
+    """
+
+    @functools.wraps(func)
+    async def wrapped(*args, **kwargs):
+        def call():
+            current_function.set(func.__name__)
+            with db_function_duration.time(function=func.__name__):
+                result = func(*args, **kwargs)
+                return list(result) if collect else result
+
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, context.run, call)
+
+    return wrapped
+
+
+get_all_values = run_in_executor(db_middleware.get_all_values, collect=True)
+get_product_summaries = run_in_executor(db_middleware.get_product_summaries)
+get_menu_page = run_in_executor(db_middleware.get_menu_page)
+get_menu_version = run_in_executor(db_middleware.get_menu_version)
+bump_menu_version = run_in_executor(db_middleware.bump_menu_version)
+get_name_by_id = run_in_executor(db_middleware.get_name_by_id)
+get_id_by_name = run_in_executor(db_middleware.get_id_by_name)
+add_user = run_in_executor(db_middleware.add_user)
+add_product = run_in_executor(db_middleware.add_product)
+add_product_from_tg = run_in_executor(db_middleware.add_product_from_tg)
+add_rating = run_in_executor(db_middleware.add_rating)
+add_comment = run_in_executor(db_middleware.add_comment)
+add_order = run_in_executor(db_middleware.add_order)
+add_to_cart = run_in_executor(db_middleware.add_to_cart)
+add_ratings = run_in_executor(db_middleware.add_ratings)
+add_comments = run_in_executor(db_middleware.add_comments)
+add_orders = run_in_executor(db_middleware.add_orders)
+check_user_by_name_and_password = run_in_executor(db_middleware.check_user_by_name_and_password)
+check_user_by_tg_id = run_in_executor(db_middleware.check_user_by_tg_id)
+set_tg_id = run_in_executor(db_middleware.set_tg_id)
+get_photo_by_id = run_in_executor(db_middleware.get_photo_by_id)
+get_photo_file_id = run_in_executor(db_middleware.get_photo_file_id)
+set_photo_file_id = run_in_executor(db_middleware.set_photo_file_id)
+clear_photo_file_id = run_in_executor(db_middleware.clear_photo_file_id)
+check_is_admin_by_tg_id = run_in_executor(db_middleware.check_is_admin_by_tg_id)
+change_product_is_available = run_in_executor(db_middleware.change_product_is_available)
+get_object_by_id = run_in_executor(db_middleware.get_object_by_id)
+delete_product_by_id = run_in_executor(db_middleware.delete_product_by_id)
+get_user_id_by_tg_id = run_in_executor(db_middleware.get_user_id_by_tg_id)
+get_user_cart_by_id = run_in_executor(db_middleware.get_user_cart_by_id, collect=True)
+cancel_order_by_id = run_in_executor(db_middleware.cancel_order_by_id)
+remove_order_item = run_in_executor(db_middleware.remove_order_item)
+migrate_orders = run_in_executor(db_middleware.migrate_orders)
+rate_limit_hit = run_in_executor(db_middleware.rate_limit_hit)
+remove_expired_rate_limits = run_in_executor(db_middleware.remove_expired_rate_limits)
+get_fsm_record = run_in_executor(db_middleware.get_fsm_record)
+save_fsm_records = run_in_executor(db_middleware.save_fsm_records)
+remove_expired_fsm_records = run_in_executor(db_middleware.remove_expired_fsm_records)
+migrate_images = run_in_executor(image_store.migrate_images)
+load_user_context = run_in_executor(db_middleware.get_user_context)
+
+
+async def get_user_context(tg_id: int) -> db_middleware.UserContext | None:
+    """Getting the user id and admin rights by Telegram id.
+    Cached users are returned without leaving the event loop
+
+    :param tg_id: Telegram id
+    :return: UserContext or None if the user is not registered
+    """
+    found, context = db_middleware.get_cached_user_context(tg_id)
+    if found:
+        return context
+    return await load_user_context(tg_id)
@@ -1,17 +1,289 @@
+import argparse
+import datetime
+import gzip
+import hashlib
+import os
 import shutil
+import sqlite3
+import tempfile
+import zlib
 
-from database.models import *
+from sqlalchemy.orm import Session
 
-if not os.path.exists(fr'{BASE_DIR}/database/backup_files'):
-    os.makedirs(fr'{BASE_DIR}/database/backup_files')
+from database.image_store import IMAGES_DIR
+from database.models import BASE_DIR, BackupHistory, engine, engine_path
+from settings import setup_logger
 
+logger = setup_logger('database')
 
-def create_backup():
-    database_file = fr'{BASE_DIR}/database/db_files/bot_db.db'
-    backup_file = fr'{BASE_DIR}/database/backup_files/bot_db.db'
+BACKUP_DIR = os.getenv('BACKUP_DIR', fr'{BASE_DIR}/backup_files')
+BACKUP_GENERATIONS = int(os.getenv('BACKUP_GENERATIONS', 7))
+BACKUP_PAGES = 256  # pages copied per step, writers can take the lock between steps
+BACKUP_SLEEP = 0.01  # seconds between steps
+BACKUP_PREFIX = 'bot_db-'
+BACKUP_SUFFIX = '.db.gz'
 
-    shutil.copyfile(database_file, backup_file)
+
+def backup_images_dir(backup_dir: str = BACKUP_DIR) -> str:
+    return os.path.join(backup_dir, 'images')
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def copy_database(source_path: str, target_path: str, pages: int = BACKUP_PAGES):
+    """Copying a database with the SQLite online backup API.
+    The copy is consistent even if the database is written meanwhile
+
+    :param source_path: database file
+    :param target_path: copy file
+    :param pages: pages copied per step
+    :return:
+    """
+    source = sqlite3.connect(source_path, timeout=30)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target, pages=pages, sleep=BACKUP_SLEEP)
+    finally:
+        target.close()
+        source.close()
+
+
+def check_database(path: str) -> list[str]:
+    """Checking database integrity
+
+    :param path: database file
+    :return: problems, empty if the database is fine
+    """
+    connection = sqlite3.connect(path)
+    try:
+        problems = [row[0] for row in connection.execute('PRAGMA integrity_check')]
+    except sqlite3.DatabaseError as ex:
+        return [repr(ex)]
+    finally:
+        connection.close()
+    return [] if problems == ['ok'] else problems
+
+
+def referenced_images(path: str) -> set[str]:
+    """Getting hashes of the images used by products
+
+    :param path: database file
+    :return: image hashes
+    """
+    connection = sqlite3.connect(path)
+    try:
+        rows = connection.execute('SELECT image_hash, thumbnail_hash, telegram_hash FROM products').fetchall()
+    except sqlite3.OperationalError:  # databases created before the image store
+        return set()
+    finally:
+        connection.close()
+    return {image_hash for row in rows for image_hash in row if image_hash}
+
+
+def copy_images(hashes: set[str], source_dir: str, target_dir: str) -> int:
+    """Copying images missing in the target store. Images are named by their content hash,
+    so images that are already there are not copied again
+
+    :param hashes: image hashes
+    :param source_dir: store to copy from
+    :param target_dir: store to copy to
+    :return: number of copied images
+    """
+    copied = 0
+    for image_hash in hashes:
+        source = os.path.join(source_dir, image_hash[:2], image_hash)
+        target = os.path.join(target_dir, image_hash[:2], image_hash)
+        if os.path.exists(target) or not os.path.exists(source):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(source, f'{target}.tmp')
+        os.replace(f'{target}.tmp', target)
+        copied += 1
+    return copied
+
+
+def prune_images(backup_dir: str = BACKUP_DIR) -> int:
+    """Removing backed up images that are not used by any kept backup.
+    Nothing is removed if a backup can not be read, its images are unknown
+
+    :param backup_dir: backups directory
+    :return: number of removed images
+    """
+    kept = set()
+    with tempfile.TemporaryDirectory(dir=backup_dir) as temp_dir:
+        copy_path = os.path.join(temp_dir, 'bot_db.db')
+        for backup in list_backups(backup_dir):
+            try:
+                extract_backup(backup, copy_path)
+            except (OSError, EOFError, zlib.error) as ex:
+                logger.error(f'Images are not pruned, backup <{backup}> can not be read: {repr(ex)}')
+                return 0
+            kept |= referenced_images(copy_path)
+
+    removed = 0
+    images_dir = backup_images_dir(backup_dir)
+    if not os.path.exists(images_dir):
+        return 0
+    for prefix in os.scandir(images_dir):
+        if not prefix.is_dir():
+            continue
+        for image in os.scandir(prefix.path):
+            if image.name not in kept:
+                os.remove(image.path)
+                removed += 1
+        if not os.listdir(prefix.path):
+            os.rmdir(prefix.path)
+    return removed
+
+
+def list_backups(backup_dir: str = BACKUP_DIR) -> list[str]:
+    """Getting backup files from the oldest to the newest
+
+    :param backup_dir: backups directory
+    :return: file paths
+    """
+    if not os.path.exists(backup_dir):
+        return []
+    return [os.path.join(backup_dir, name) for name in sorted(os.listdir(backup_dir))
+            if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)]
+
+
+def create_backup(database_path: str = engine_path, backup_dir: str = BACKUP_DIR,
+                  generations: int = BACKUP_GENERATIONS) -> str:
+    """Creating a compressed backup of the database and copying new images.
+    The backup is recorded in backup_history, only the newest generations and their images are kept
+
+    :param database_path: database file
+    :param backup_dir: backups directory
+    :param generations: number of backups to keep
+    :return: backup file path
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    backup_time = datetime.datetime.now()
+    backup_path = os.path.join(backup_dir, f'{BACKUP_PREFIX}{backup_time:%Y%m%d-%H%M%S-%f}{BACKUP_SUFFIX}')
+
+    with tempfile.TemporaryDirectory(dir=backup_dir) as temp_dir:
+        copy_path = os.path.join(temp_dir, 'bot_db.db')
+        copy_database(database_path, copy_path)
+        problems = check_database(copy_path)
+        if problems:
+            raise RuntimeError(f'Backup of <{database_path}> is damaged: {problems}')
+
+        images = copy_images(referenced_images(copy_path), IMAGES_DIR, backup_images_dir(backup_dir))
+
+        with open(copy_path, 'rb') as source, gzip.open(f'{backup_path}.tmp', 'wb', compresslevel=6) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+        os.replace(f'{backup_path}.tmp', backup_path)
+
+    with Session(bind=engine) as session:
+        session.add(BackupHistory(backup_time=backup_time, file_name=os.path.basename(backup_path),
+                                  size=os.path.getsize(backup_path), sha256=file_sha256(backup_path)))
+        session.commit()
+
+    old_backups = list_backups(backup_dir)[:-generations]
+    for old_backup in old_backups:
+        os.remove(old_backup)
+        logger.info(f'Backup <{old_backup}> removed')
+    if old_backups:
+        removed = prune_images(backup_dir)
+        if removed:
+            logger.info(f'{removed} images of removed backups deleted')
+
+    logger.info(f'Backup <{backup_path}> created, {images} new images copied')
+    return backup_path
+
+
+def extract_backup(backup_path: str, target_path: str):
+    with gzip.open(backup_path, 'rb') as source, open(target_path, 'wb') as target:
+        shutil.copyfileobj(source, target, 1024 * 1024)
+
+
+def verify_backup(backup_path: str, backup_dir: str = BACKUP_DIR) -> list[str]:
+    """Checking a backup: checksum recorded in backup_history, database integrity and images
+
+    :param backup_path: backup file
+    :param backup_dir: backups directory with the images
+    :return: problems, empty if the backup can be restored
+    """
+    problems = []
+    with Session(bind=engine) as session:
+        recorded = session.query(BackupHistory.sha256).filter(
+            BackupHistory.file_name == os.path.basename(backup_path)).scalar()
+    if recorded and recorded != file_sha256(backup_path):
+        problems.append('checksum does not match backup_history')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        copy_path = os.path.join(temp_dir, 'bot_db.db')
+        try:
+            extract_backup(backup_path, copy_path)
+        except (OSError, EOFError, zlib.error) as ex:
+            return problems + [f'archive is damaged: {repr(ex)}']
+        problems += check_database(copy_path)
+
+        images_dir = backup_images_dir(backup_dir)
+        missing = [image_hash for image_hash in referenced_images(copy_path)
+                   if not os.path.exists(os.path.join(images_dir, image_hash[:2], image_hash))]
+        if missing:
+            problems.append(f'{len(missing)} images are missing')
+
+    return problems
+
+
+def restore_backup(backup_path: str, database_path: str = engine_path, backup_dir: str = BACKUP_DIR):
+    """Replacing the database with a verified backup and restoring missing images.
+    The database is written with the online backup API, so it can stay open,
+    the app should be restarted afterwards to drop its caches
+
+    :param backup_path: backup file
+    :param database_path: database file
+    :param backup_dir: backups directory with the images
+    :return:
+    """
+    problems = verify_backup(backup_path, backup_dir)
+    if problems:
+        raise RuntimeError(f'Backup <{backup_path}> can not be restored: {problems}')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        copy_path = os.path.join(temp_dir, 'bot_db.db')
+        extract_backup(backup_path, copy_path)
+        images = copy_images(referenced_images(copy_path), backup_images_dir(backup_dir), IMAGES_DIR)
+        copy_database(copy_path, database_path)
+
+    logger.info(f'Backup <{backup_path}> restored to <{database_path}>, {images} images restored')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Database backups')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('create', help='create a backup')
+    commands.add_parser('list', help='list backups')
+    verify_parser = commands.add_parser('verify', help='check a backup, the newest one by default')
+    verify_parser.add_argument('backup', nargs='?')
+    restore_parser = commands.add_parser('restore', help='restore the database from a backup')
+    restore_parser.add_argument('backup')
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        print(create_backup())
+    elif args.command == 'list':
+        for backup in list_backups():
+            print(f'{backup}\t{os.path.getsize(backup)}')
+    elif args.command == 'verify':
+        backup = args.backup or (list_backups() or [None])[-1]
+        if backup is None:
+            parser.error('there are no backups')
+        problems = verify_backup(backup)
+        print('\n'.join(problems) or 'ok')
+        raise SystemExit(1 if problems else 0)
+    elif args.command == 'restore':
+        restore_backup(args.backup)
 
 
 if __name__ == '__main__':
-    create_backup()
+    main()
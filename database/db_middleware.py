@@ -1,25 +1,100 @@
-import base64
 import hashlib
-import logging
-import tempfile
+import io
+import os
+import threading
+import time
 from datetime import datetime
-from typing import Type, Generator, Union, Iterable, NamedTuple
+from typing import Type, Generator, Union, Iterable, NamedTuple, Callable
 
+from cachetools import TTLCache
+from sqlalchemy import or_, func, text, inspect, exists, select, literal
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import Session
 
-from database.models import Base, User, Product, Order, Comment, Rating, Admin, engine
+from database.image_store import save_renditions, read_image, delete_image, normalize_image_data
+from database.models import Base, User, Product, ProductPhoto, Order, OrderItem, Comment, Rating, Admin, RateLimit, FSMRecord, \
+    MenuVersion, UserVersion, engine
 from settings import setup_logger
 
 logger = setup_logger('database')
 
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 300))
+USER_CACHE_MISS_TTL = float(os.getenv('USER_CACHE_MISS_TTL', 2))  # seconds unknown users are cached
+USER_CACHE_CHECK_INTERVAL = float(os.getenv('USER_CACHE_CHECK_INTERVAL', 1))  # seconds between user version checks
+
+# get_photo_by_id rendition: product column with the image hash
+PHOTO_RENDITIONS = {
+    'original': Product.image_hash,
+    'thumbnail': Product.thumbnail_hash,
+    'telegram': Product.telegram_hash,
+}
+
+# rows inserted per transaction by the bulk functions, also keeps IN queries under the SQLite variables limit
+BULK_CHUNK_SIZE = 500
+
 
 class Cart(NamedTuple):
+    order_id: int
+    product_id: int
     name: str
     quantity: int
     cash: float
-    cancelled: bool
-    photo_id: int
-    order_id: int
+    total: float
+
+
+class UserContext(NamedTuple):
+    id: int
+    is_admin: bool
+    admin_level: int | None
+
+
+class BulkResult(NamedTuple):
+    inserted: int
+    failed: list[tuple[int, str]]  # (row number, reason)
+
+
+class ProductSummary(NamedTuple):
+    id: int
+    name: str
+    price: float
+    is_available: bool
+    thumbnail_hash: str | None
+
+
+class MenuPage(NamedTuple):
+    product: ProductSummary
+    has_previous: bool
+    has_next: bool
+
+
+def get_menu_version() -> int:
+    """Getting the menu version. It changes every time products are added, changed or deleted.
+    The version is kept in the database, so all workers see the same one
+
+    :return: menu version
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            return session.query(MenuVersion.version).filter(MenuVersion.id == 1).scalar() or 0
+        except Exception as ex:
+            logger.error(repr(ex))
+            return 0
+
+
+def bump_menu_version():
+    """Changing the menu version after products have been changed
+
+    :return:
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            statement = insert(MenuVersion).values(id=1, version=1)
+            session.execute(statement.on_conflict_do_update(index_elements=[MenuVersion.id],
+                                                            set_={'version': MenuVersion.version + 1}))
+            session.commit()
+        except Exception as ex:
+            logger.error(repr(ex))
 
 
 def get_all_values(cls: Type[Base]) -> Generator:
@@ -38,6 +113,54 @@ def get_all_values(cls: Type[Base]) -> Generator:
             return
 
 
+def get_product_summaries(only_available: bool = True) -> list[ProductSummary]:
+    """Getting products for listings without loading their images
+
+    :param only_available: return only products available for order
+    :return: list of ProductSummary
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            query = session.query(Product.id, Product.name, Product.price, Product.is_available,
+                                  func.coalesce(Product.thumbnail_hash, Product.image_hash))
+            if only_available:
+                query = query.filter(Product.is_available.is_(True))
+            return [ProductSummary(*row) for row in query.order_by(Product.id)]
+        except Exception as ex:
+            logger.error(repr(ex))
+            return []
+
+
+def get_menu_page(product_id: int = 0, direction: str = 'next') -> MenuPage | None:
+    """Getting one available product of the menu next to a product, using the primary key instead of an offset,
+    so the query costs the same on any page of any menu
+
+    :param product_id: id of the product the user is looking at, 0 for the first page
+    :param direction: next or previous
+    :return: MenuPage or None if there is no product in that direction
+    """
+    available = Product.is_available.is_(True)
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            query = session.query(Product.id, Product.name, Product.price, Product.is_available,
+                                  func.coalesce(Product.thumbnail_hash, Product.image_hash)).filter(available)
+            if direction == 'next':
+                query = query.filter(Product.id > product_id).order_by(Product.id)
+            else:
+                query = query.filter(Product.id < product_id).order_by(Product.id.desc())
+            row = query.first()
+            if row is None:
+                return
+            product = ProductSummary(*row)
+
+            has_previous, has_next = session.query(exists().where(available, Product.id < product.id),
+                                                   exists().where(available, Product.id > product.id)).one()
+            return MenuPage(product, has_previous, has_next)
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
 def get_name_by_id(cls: Type[Base], id_: int):
     """Getting name from the database by id
 
@@ -51,7 +174,7 @@ def get_name_by_id(cls: Type[Base], id_: int):
             if obj:
                 return obj.name
             else:
-                logging.warning(f'Object from id:<{id_}> not found in table <{cls.__name__}>')
+                logger.warning(f'Object from id:<{id_}> not found in table <{cls.__name__}>')
                 return
         except Exception as ex:
             logger.error(repr(ex))
@@ -71,18 +194,111 @@ def get_id_by_name(cls: Type[Base], name: str):
             if obj:
                 return obj.id
             else:
-                logging.warning(f'Object name:<{name}> not found in table <{cls.__name__}>')
+                logger.warning(f'Object name:<{name}> not found in table <{cls.__name__}>')
         except Exception as ex:
             logger.error(repr(ex))
             return
 
 
-def add_user(name: str, address: str, password: str, phone_number: str, is_admin: bool = None,
-             admin_level: int = 1, tg_id: int = None) -> User | None:
+def resolve_references(cls: Type[Base], references: Iterable[Union[int, str]]) -> dict[Union[int, str], int]:
+    """Resolving names and checking ids of existing rows, one IN query per chunk
+
+    :param cls: table object
+    :param references: names or ids
+    :return: reference: id for the references found
+    """
+    references = list(set(references))
+    resolved = {}
+    with Session(autoflush=True, bind=engine) as session:
+        for start in range(0, len(references), BULK_CHUNK_SIZE):
+            chunk = references[start:start + BULK_CHUNK_SIZE]
+            names = {reference for reference in chunk if type(reference) is str}
+            ids = {reference for reference in chunk if type(reference) is not str}
+            for id_, name in session.query(cls.id, cls.name).filter(or_(cls.name.in_(names), cls.id.in_(ids))):
+                if name in names:
+                    resolved[name] = id_
+                if id_ in ids:
+                    resolved[id_] = id_
+    return resolved
+
+
+def bulk_insert(cls: Type[Base], rows: Iterable[dict], columns: dict[str, tuple[str, object]],
+                chunk_size: int = BULK_CHUNK_SIZE, write: Callable[[Session, list[dict]], None] = None) -> BulkResult:
+    """Inserting rows that reference a user and a product, chunk_size rows per transaction.
+    Users and products are resolved for all rows at once. If a chunk fails,
+    its rows are inserted one by one to find the failed ones
+
+    :param cls: Order, Rating or Comment
+    :param rows: dicts with user, product and the keys of columns
+    :param columns: row key: (column name, value used for missing keys and None), user and product included
+    :param chunk_size: rows per transaction
+    :param write: function inserting a list of column values in a session, executemany into cls by default
+    :return: number of inserted rows and failed rows
+    """
+    rows = list(rows)
+    failed = []
+    try:
+        users = resolve_references(User, (row['user'] for row in rows if 'user' in row))
+        products = resolve_references(Product, (row['product'] for row in rows if 'product' in row))
+    except Exception as ex:
+        logger.error(repr(ex))
+        return BulkResult(0, [(number, repr(ex)) for number in range(len(rows))])
+
+    values = []
+    for number, row in enumerate(rows):
+        if users.get(row.get('user')) is None:
+            failed.append((number, f'User <{row.get("user")}> does not exists'))
+            continue
+        if products.get(row.get('product')) is None:
+            failed.append((number, f'Product <{row.get("product")}> does not exists'))
+            continue
+        resolved = dict(row, user=users[row['user']], product=products[row['product']])
+        values.append((number, {column: default if resolved.get(key) is None else resolved[key]
+                                for key, (column, default) in columns.items()}))
+
+    if write is None:
+        def write(session_: Session, values_: list[dict]):
+            session_.execute(insert(cls), values_)
+
+    inserted = 0
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        try:
+            with Session(autoflush=True, bind=engine) as session:
+                write(session, [value for _, value in chunk])
+                session.commit()
+            inserted += len(chunk)
+            continue
+        except Exception as ex:
+            logger.warning(f'Chunk of {len(chunk)} rows not inserted into <{cls.__tablename__}>, '
+                           f'inserting one by one: {repr(ex)}')
+
+        with Session(autoflush=True, bind=engine) as session:
+            for number, value in chunk:
+                try:
+                    with session.begin_nested():
+                        write(session, [value])
+                    inserted += 1
+                except Exception as ex:
+                    failed.append((number, repr(ex)))
+            session.commit()
+
+    if failed:
+        logger.warning(f'{len(failed)} rows not inserted into <{cls.__tablename__}>')
+    return BulkResult(inserted, sorted(failed))
+
+
+def hash_password(password: str) -> str:
+    return hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+
+def add_user(name: str, address: str, password: str | None, phone_number: str, is_admin: bool = None,
+             admin_level: int = 1, tg_id: int = None, password_hash: str = None) -> User | None:
     """Creates a new user in the database
 
     :param tg_id: telegram id
     :param password: user password
+    :param password_hash: hash_password of the user password, used instead of the password
     :param admin_level: admin level
     :param name: username
     :param address: user address
@@ -92,7 +308,7 @@ def add_user(name: str, address: str, password: str, phone_number: str, is_admin
     """
     with Session(autoflush=True, bind=engine) as session:
         try:
-            password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
+            password_hash = password_hash or hash_password(password)
             if tg_id:
                 new_user = User(telegram_id=tg_id, name=name, password=password_hash, address=address,
                                 phone_number=phone_number,
@@ -107,6 +323,8 @@ def add_user(name: str, address: str, password: str, phone_number: str, is_admin
                 admin = Admin(user_id=new_user.id, admin_level=admin_level)
                 session.add(admin)
                 session.commit()
+            if tg_id:
+                invalidate_user_context(tg_id)
             return new_user
         except Exception as ex:
             logger.error(repr(ex))
@@ -125,11 +343,12 @@ def add_product(name: str, price: Union[float, int], photo_path: str, is_availab
     with Session(autoflush=True, bind=engine) as session:
         try:
             with open(fr'{photo_path}', 'rb') as file:
-                image_data = file.read()
+                hashes = save_renditions(file.read())
 
-            new_product = Product(name=name, price=price, is_available=is_available, image_data=image_data)
+            new_product = Product(name=name, price=price, is_available=is_available, **hashes)
             session.add(new_product)
             session.commit()
+            bump_menu_version()
 
             return new_product
         except Exception as ex:
@@ -137,7 +356,7 @@ def add_product(name: str, price: Union[float, int], photo_path: str, is_availab
             return
 
 
-async def add_product_from_tg(name: str, price: float, photo: bytes, is_available: bool = False) -> Product | None:
+def add_product_from_tg(name: str, price: float, photo: bytes, is_available: bool = False) -> Product | None:
     """Creates a product in the database
 
     :param is_available: product available for order or not
@@ -148,11 +367,12 @@ async def add_product_from_tg(name: str, price: float, photo: bytes, is_availabl
     """
     with Session(autoflush=True, bind=engine) as session:
         try:
-            encoded_photo = base64.b64encode(photo).decode('utf-8')  # Кодируем фото в формате base64
+            hashes = save_renditions(photo)
 
-            new_product = Product(name=name, price=price, is_available=is_available, image_data=encoded_photo)
+            new_product = Product(name=name, price=price, is_available=is_available, **hashes)
             session.add(new_product)
             session.commit()
+            bump_menu_version()
 
             return new_product
         except Exception as ex:
@@ -173,12 +393,12 @@ def add_rating(user: Union[int, str], product: Union[int, str], rating_value: in
             if type(user) is str:
                 user = get_id_by_name(User, user)
                 if not user:
-                    logging.warning(f'User <{user}> does not exists')
+                    logger.warning(f'User <{user}> does not exists')
                     return
             if type(product) is str:
                 product = get_id_by_name(Product, product)
                 if not product:
-                    logging.warning(f'Product <{product}> does not exists')
+                    logger.warning(f'Product <{product}> does not exists')
                     return
 
             new_rating = Rating(user_id=user, product_id=product, rating_value=rating_value)
@@ -203,12 +423,12 @@ def add_comment(user: Union[int, str], product: Union[int, str], comment_text: s
             if type(user) is str:
                 user = get_id_by_name(User, user)
                 if not user:
-                    logging.warning(f'User <{user}> does not exists')
+                    logger.warning(f'User <{user}> does not exists')
                     return
             if type(product) is str:
                 product = get_id_by_name(Product, product)
                 if not product:
-                    logging.warning(f'Product <{product}> does not exists')
+                    logger.warning(f'Product <{product}> does not exists')
                     return
 
             new_comment = Comment(user_id=user, product_id=product, comment_text=comment_text)
@@ -222,7 +442,7 @@ def add_comment(user: Union[int, str], product: Union[int, str], comment_text: s
 
 def add_order(user: Union[int, str], order_time: datetime, product: Union[int, str], quantity: int = 1,
               is_cancelled: bool = False) -> Order | None:
-    """Adding an order to the database
+    """Adding an order with one product to the database
 
     :param product: id or product name
     :param user: username or user id
@@ -236,17 +456,17 @@ def add_order(user: Union[int, str], order_time: datetime, product: Union[int, s
             if type(user) is str:
                 user = get_id_by_name(User, user)
                 if not user:
-                    logging.warning(f'User <{user}> does not exists')
+                    logger.warning(f'User <{user}> does not exists')
                     return
 
-            if type(product) is str:
-                product = get_id_by_name(Product, product)
-                if not product:
-                    logging.warning(f'Product <{product}> does not exists')
-                    return
+            found = session.query(Product.id, Product.price).filter(
+                Product.name == product if type(product) is str else Product.id == product).first()
+            if not found:
+                logger.warning(f'Product <{product}> does not exists')
+                return
 
-            new_order = Order(user_id=user, order_time=order_time, is_cancelled=is_cancelled, product=product,
-                              quantity=quantity)
+            new_order = Order(user_id=user, order_time=order_time, is_cancelled=is_cancelled,
+                              items=[OrderItem(product_id=found.id, quantity=quantity, price=found.price)])
             session.add(new_order)
             session.commit()
             return new_order
@@ -255,6 +475,108 @@ def add_order(user: Union[int, str], order_time: datetime, product: Union[int, s
         return
 
 
+def add_to_cart(user_id: int, items: Iterable[tuple[int, int]], order_time: datetime = None) -> int | None:
+    """Adding products to the user's cart in one transaction.
+    The cart is the last not cancelled order of the user, it is created if there is none.
+    Quantities of products that are already in the cart are increased
+
+    :param user_id: user id
+    :param items: (product id, quantity)
+    :param order_time: time of a new order, now by default
+    :return: order id
+    """
+    quantities = {}
+    for product_id, quantity in items:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            open_orders = session.query(Order.id).filter(Order.user_id == user_id, Order.is_cancelled.isnot(True))
+            # the cart is created by the first statement, it takes the write lock, so concurrent adds
+            # of the user wait for this transaction and find the same cart
+            session.execute(insert(Order).from_select(
+                ['user_id', 'order_time', 'is_cancelled'],
+                select(literal(user_id), literal(order_time or datetime.now()), literal(False))
+                .where(~open_orders.exists())))
+            order_id = open_orders.order_by(Order.id.desc()).limit(1).scalar()
+
+            prices = dict(session.query(Product.id, Product.price).filter(Product.id.in_(quantities)))
+            for product_id in quantities:
+                if product_id not in prices:
+                    logger.warning(f'Product id:<{product_id}> does not exists')
+                    session.rollback()
+                    return
+
+            statement = insert(OrderItem)
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[OrderItem.order_id, OrderItem.product_id],
+                set_={'quantity': OrderItem.quantity + statement.excluded.quantity}
+            ), [{'order_id': order_id, 'product_id': product_id, 'quantity': quantity, 'price': prices[product_id]}
+                for product_id, quantity in quantities.items()])
+            session.commit()
+            return order_id
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def add_ratings(ratings: Iterable[dict], chunk_size: int = BULK_CHUNK_SIZE) -> BulkResult:
+    """Adding ratings in chunks
+
+    :param ratings: dicts with add_rating arguments: user, product, rating_value
+    :param chunk_size: rows per transaction
+    :return: number of inserted rows and failed rows
+    """
+    return bulk_insert(Rating, ratings, {
+        'user': ('user_id', None),
+        'product': ('product_id', None),
+        'rating_value': ('rating_value', Rating.rating_value.default.arg),
+    }, chunk_size)
+
+
+def add_comments(comments: Iterable[dict], chunk_size: int = BULK_CHUNK_SIZE) -> BulkResult:
+    """Adding comments in chunks
+
+    :param comments: dicts with add_comment arguments: user, product, comment_text
+    :param chunk_size: rows per transaction
+    :return: number of inserted rows and failed rows
+    """
+    return bulk_insert(Comment, comments, {
+        'user': ('user_id', None),
+        'product': ('product_id', None),
+        'comment_text': ('comment_text', None),
+    }, chunk_size)
+
+
+def add_orders(orders: Iterable[dict], chunk_size: int = BULK_CHUNK_SIZE) -> BulkResult:
+    """Adding orders with one product each in chunks
+
+    :param orders: dicts with add_order arguments: user, order_time, product, quantity, is_cancelled
+    :param chunk_size: rows per transaction
+    :return: number of inserted rows and failed rows
+    """
+
+    def write(session: Session, values: list[dict]):
+        order_ids = session.execute(
+            insert(Order).returning(Order.id, sort_by_parameter_order=True),
+            [{column: value[column] for column in ('user_id', 'order_time', 'is_cancelled')} for value in values]
+        ).scalars().all()
+        prices = dict(session.query(Product.id, Product.price).filter(
+            Product.id.in_({value['product_id'] for value in values})))
+        session.execute(insert(OrderItem), [
+            {'order_id': order_id, 'product_id': value['product_id'], 'quantity': value['quantity'],
+             'price': prices[value['product_id']]}
+            for order_id, value in zip(order_ids, values)])
+
+    return bulk_insert(Order, orders, {
+        'user': ('user_id', None),
+        'product': ('product_id', None),
+        'order_time': ('order_time', None),
+        'quantity': ('quantity', 1),
+        'is_cancelled': ('is_cancelled', False),
+    }, chunk_size, write)
+
+
 def check_user_by_name_and_password(name: str, password: str) -> bool | None:
     """Checks for the existence of a user by name and password
 
@@ -262,37 +584,173 @@ def check_user_by_name_and_password(name: str, password: str) -> bool | None:
     :param password: user password
     :return:
     """
-    password_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
+    password_hash = hash_password(password)
     with Session(autoflush=True, bind=engine) as session:
         try:
             user = session.query(User).filter_by(name=name, password=password_hash).first()
             if user:
                 return True
             else:
-                logger.warning(f'User <{name}> <{password}> not found')
+                logger.warning(f'User <{name}> not found or the password is wrong')
                 return
         except Exception as ex:
             logger.error(repr(ex))
 
 
-def check_user_by_tg_id(tg_id: int) -> bool | None:
-    """User Telegram id check
+def get_user_version() -> int:
+    """Getting the users version. It changes every time users are added or changed.
+    The version is kept in the database, so all workers see the same one
 
-    :param tg_id: user Telegram id
-    :return: True if exists and None if not exists
+    :return: users version
     """
     with Session(autoflush=True, bind=engine) as session:
         try:
-            user = session.query(User).filter_by(telegram_id=tg_id).first()
-            if user:
-                return True
+            return session.query(UserVersion.version).filter(UserVersion.id == 1).scalar() or 0
+        except Exception as ex:
+            logger.error(repr(ex))
+            return 0
+
+
+def bump_user_version():
+    """Changing the users version after users have been changed, so other workers drop their cached users
+
+    :return:
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            statement = insert(UserVersion).values(id=1, version=1)
+            session.execute(statement.on_conflict_do_update(index_elements=[UserVersion.id],
+                                                            set_={'version': UserVersion.version + 1}))
+            session.commit()
+        except Exception as ex:
+            logger.error(repr(ex))
+
+
+class UserContextCache:
+    """Users by Telegram id kept in the memory of one worker.
+    Writers bump the users version in the database, a cache is cleared when it sees a new version.
+    The version is read at most once per check_interval, so changes made by other workers are seen
+    within the interval. Unknown users are kept for miss_ttl seconds only"""
+
+    def __init__(self, size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL,
+                 miss_ttl: float = USER_CACHE_MISS_TTL, check_interval: float = USER_CACHE_CHECK_INTERVAL):
+        self.users = TTLCache(maxsize=size, ttl=ttl)
+        self.unknown = TTLCache(maxsize=size, ttl=miss_ttl)
+        self.check_interval = check_interval
+        self.version: int | None = None
+        self.checked = float('-inf')
+        self.lock = threading.Lock()
+
+    def is_checked(self) -> bool:
+        return time.monotonic() - self.checked < self.check_interval
+
+    def sync(self):
+        """Reading the users version if it was not checked recently, the cache is cleared if it changed
+
+        :return:
+        """
+        if self.is_checked():
+            return
+        version = get_user_version()
+        with self.lock:
+            if version != self.version:
+                self.users.clear()
+                self.unknown.clear()
+                self.version = version
+            self.checked = time.monotonic()
+
+    def get(self, tg_id: int) -> tuple[bool, UserContext | None]:
+        """Getting a user without querying the database.
+        Nothing is found while the users version has to be checked
+
+        :param tg_id: Telegram id
+        :return: (True, UserContext or None) if the user is cached, otherwise (False, None)
+        """
+        with self.lock:
+            if not self.is_checked():
+                return False, None
+            if tg_id in self.users:
+                return True, self.users[tg_id]
+            if tg_id in self.unknown:
+                return True, None
+        return False, None
+
+    def set(self, tg_id: int, context: UserContext | None):
+        with self.lock:
+            if context is None:
+                self.unknown[tg_id] = None
             else:
-                logger.warning(f'User telegram_id:<{tg_id}> not found')
-                return
+                self.users[tg_id] = context
+
+    def invalidate(self, *tg_ids: int):
+        with self.lock:
+            for tg_id in tg_ids:
+                self.users.pop(tg_id, None)
+                self.unknown.pop(tg_id, None)
+
+
+user_context_cache = UserContextCache()
+
+
+def get_user_context(tg_id: int) -> UserContext | None:
+    """Getting the user id and admin rights by Telegram id.
+    Results are cached until the user is changed by any worker or USER_CACHE_TTL expires,
+    unknown users are cached for USER_CACHE_MISS_TTL
+
+    :param tg_id: Telegram id
+    :return: UserContext or None if the user is not registered
+    """
+    user_context_cache.sync()
+    found, context = user_context_cache.get(tg_id)
+    if found:
+        return context
+
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            row = session.query(User.id, User.is_admin, Admin.admin_level) \
+                .outerjoin(Admin, Admin.user_id == User.id) \
+                .filter(User.telegram_id == tg_id).first()
         except Exception as ex:
             logger.error(repr(ex))
             return
 
+    context = UserContext(*row) if row else None
+    user_context_cache.set(tg_id, context)
+    return context
+
+
+def get_cached_user_context(tg_id: int) -> tuple[bool, UserContext | None]:
+    """Getting a user from the user context cache without querying the database
+
+    :param tg_id: Telegram id
+    :return: (True, UserContext or None) if the user is cached, otherwise (False, None)
+    """
+    return user_context_cache.get(tg_id)
+
+
+def invalidate_user_context(*tg_ids: int):
+    """Removing users from the user context cache after they have been changed.
+    Other workers drop their cached users when they see the new users version
+
+    :param tg_ids: Telegram ids
+    :return:
+    """
+    user_context_cache.invalidate(*tg_ids)
+    bump_user_version()
+
+
+def check_user_by_tg_id(tg_id: int) -> bool | None:
+    """User Telegram id check
+
+    :param tg_id: user Telegram id
+    :return: True if exists and None if not exists
+    """
+    if get_user_context(tg_id):
+        return True
+    else:
+        logger.warning(f'User telegram_id:<{tg_id}> not found')
+        return
+
 
 def set_tg_id(tg_id: int, username: str) -> Type[User] | None:
     """Установка Telegram id в поле id пользователя
@@ -305,8 +763,10 @@ def set_tg_id(tg_id: int, username: str) -> Type[User] | None:
         try:
             user = session.query(User).filter_by(name=username).first()
             if user:
+                old_tg_id = user.telegram_id
                 user.telegram_id = tg_id
                 session.commit()
+                invalidate_user_context(old_tg_id, tg_id)
                 return user
             else:
                 logger.warning(f'User telegram_id:<{tg_id}> not found')
@@ -316,47 +776,98 @@ def set_tg_id(tg_id: int, username: str) -> Type[User] | None:
             return
 
 
-def get_photo_by_id(product_id: int) -> str | None:
-    """Getting a photo by id
+def get_photo_by_id(product_id: int, rendition: str = 'telegram') -> io.BytesIO | None:
+    """Getting a photo by id.
+    Images not moved to the store yet, or missing from it, are read from the products table
 
     :param product_id: product id
-    :return: Path
+    :param rendition: 'telegram', 'thumbnail' or 'original'
+    :return: in-memory file object with the photo
     """
+    if rendition not in PHOTO_RENDITIONS:
+        raise ValueError(f'Unknown rendition <{rendition}>')
+    rendition_hash = PHOTO_RENDITIONS[rendition]
     with Session(autoflush=True, bind=engine) as session:
         try:
-            product = session.query(Product).filter(Product.id == product_id).first()
-            if product:
-                image_data = product.image_data
-                with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-                    temp_file.write(image_data)
+            product = session.query(rendition_hash.label('rendition_hash'), Product.image_hash) \
+                .filter(Product.id == product_id).first()
+            if product and product.image_hash:
+                image_hash = product.rendition_hash or product.image_hash
+                image_data = read_image(image_hash)
+                if image_data is not None:
+                    return io.BytesIO(image_data)
+                logger.warning(f'Image <{image_hash}> of product id:<{product_id}> is missing from the store')
+
+            image_data = session.query(Product.image_data).filter(Product.id == product_id).scalar() \
+                if product else None
+            if image_data:
+                return io.BytesIO(normalize_image_data(image_data))
+            logger.warning(f'Image image_id:<{product_id}> not found')
+            return
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
 
-                    photo_path = temp_file.name
 
-                return photo_path
-            else:
-                logger.warning(f'Image image_id:<{product.id}> not found')
-                return
+def get_photo_file_id(product_id: int) -> str | None:
+    """Getting the Telegram file_id of an already uploaded product photo
+
+    :param product_id: product id
+    :return: Telegram file_id or None if the photo has not been uploaded yet
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            photo = session.get(ProductPhoto, product_id)
+            if photo:
+                return photo.telegram_file_id
         except Exception as ex:
             logger.error(repr(ex))
             return
 
 
-def check_is_admin_by_tg_id(tg_id: id) -> bool | None:
-    """Checking if a user is an admin by his Telegram id
+def set_photo_file_id(product_id: int, file_id: str) -> bool | None:
+    """Saving the Telegram file_id of an uploaded product photo
 
-    :param tg_id: Telegram id
-    :return: True if user is admin
+    :param product_id: product id
+    :param file_id: Telegram file_id
+    :return: True if saved
     """
     with Session(autoflush=True, bind=engine) as session:
         try:
-            user = session.query(User).filter(User.telegram_id == tg_id).first()
-            if user.is_admin:
-                return True
+            session.merge(ProductPhoto(product_id=product_id, telegram_file_id=file_id))
+            session.commit()
+            return True
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def clear_photo_file_id(product_id: int) -> None:
+    """Removing the Telegram file_id of a product photo, the next sending uploads the photo again
+
+    :param product_id: product id
+    :return:
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            session.query(ProductPhoto).filter(ProductPhoto.product_id == product_id).delete()
+            session.commit()
         except Exception as ex:
             logger.error(repr(ex))
             return
 
 
+def check_is_admin_by_tg_id(tg_id: id) -> bool | None:
+    """Checking if a user is an admin by his Telegram id
+
+    :param tg_id: Telegram id
+    :return: True if user is admin
+    """
+    user = get_user_context(tg_id)
+    if user and user.is_admin:
+        return True
+
+
 def change_product_is_available(product_id: int, is_available: bool) -> Type[Product] | None:
     """Product state change
 
@@ -370,6 +881,7 @@ def change_product_is_available(product_id: int, is_available: bool) -> Type[Pro
             if product:
                 product.is_available = is_available
                 session.commit()
+                bump_menu_version()
                 return product
             else:
                 logger.warning(f'Product id:<{product_id}> not found')
@@ -392,28 +904,47 @@ def get_object_by_id(cls: Type[Base], id_: int):
             if obj:
                 return obj
             else:
-                logging.warning(f'Object from id:<{id_}> not found in table <{cls.__name__}>')
+                logger.warning(f'Object from id:<{id_}> not found in table <{cls.__name__}>')
                 return
         except Exception as ex:
             logger.error(repr(ex))
             return
 
 
-def delete_product_by_id(cls: Type[Base], id_: int):
-    """Delete object from the database by id
+def delete_product_by_id(cls: Type[Base], id_: int) -> bool | None:
+    """Delete object from the database by id.
+    Products that are in orders are kept for the order history and made unavailable instead
 
     :param cls: table object
     :param id_: id value
-    :return:
+    :return: True if deleted, False if the product is in orders and was made unavailable
     """
     with Session(autoflush=True, bind=engine) as session:
         try:
             obj = session.query(cls).filter(cls.id == id_).first()
             if obj:
+                if cls is Product and session.query(OrderItem.id).filter(OrderItem.product_id == id_).first():
+                    obj.is_available = False
+                    session.commit()
+                    bump_menu_version()
+                    logger.info(f'Product id:<{id_}> is in orders, made unavailable instead of deleting')
+                    return False
+                image_hashes = set()
+                if cls is Product:
+                    image_hashes = {obj.image_hash, obj.thumbnail_hash, obj.telegram_hash} - {None}
+                    session.query(ProductPhoto).filter(ProductPhoto.product_id == id_).delete()
                 session.delete(obj)
                 session.commit()
+                if cls is Product:
+                    bump_menu_version()
+                for image_hash in image_hashes:
+                    if not session.query(Product.id).filter(or_(Product.image_hash == image_hash,
+                                                                Product.thumbnail_hash == image_hash,
+                                                                Product.telegram_hash == image_hash)).first():
+                        delete_image(image_hash)
+                return True
             else:
-                logging.warning(f'Object from id:<{id_}> not found in table <{cls.__name__}>')
+                logger.warning(f'Object from id:<{id_}> not found in table <{cls.__name__}>')
                 return
         except Exception as ex:
             logger.error(repr(ex))
@@ -426,60 +957,205 @@ def get_user_id_by_tg_id(tg_id: int) -> int | None:
     :param tg_id: Telegram id
     :return: user id
     """
-    with Session(autoflush=True, bind=engine) as session:
-        try:
-            user = session.query(User).filter(User.telegram_id == tg_id).first()
-            if user:
-                return user.id
-            else:
-                logging.warning(f'User from telegram_id:<{tg_id}> not found>')
-                return
-        except Exception as ex:
-            logger.error(repr(ex))
-            return
+    user = get_user_context(tg_id)
+    if user:
+        return user.id
+    else:
+        logger.warning(f'User from telegram_id:<{tg_id}> not found>')
+        return
 
 
 def get_user_cart_by_id(user_id: int) -> Iterable | None:
-    """Receiving user orders
+    """Receiving items of user orders that are not cancelled with order totals in a single query
 
     :param user_id: user_id
-    :return: Order
+    :return: Cart
     """
     with Session(autoflush=True, bind=engine) as session:
         try:
-            user = session.query(User).filter(User.id == user_id).first()
-            if user:
-                orders = user.orders
-                for order in orders:
-                    products = session.query(Product).filter(Product.orders.any(Order.id == order.id)).all()
-                    for product in products:
-                        cash = product.price * order.quantity
-                        yield Cart(name=product.name, quantity=order.quantity, cash=cash, cancelled=order.is_cancelled,
-                                   photo_id=product.id, order_id=order.id)
-            else:
-                logging.warning(f'User from id:<{user_id}> not found>')
-                return
+            cash = OrderItem.price * OrderItem.quantity
+            rows = session.query(Order.id, Product.id, Product.name, OrderItem.quantity, cash.label('cash'),
+                                 func.sum(cash).over(partition_by=Order.id).label('total')) \
+                .join(OrderItem, OrderItem.order_id == Order.id) \
+                .join(Product, OrderItem.product_id == Product.id) \
+                .filter(Order.user_id == user_id, Order.is_cancelled.isnot(True)) \
+                .order_by(Order.id, OrderItem.id)
+            for row in rows:
+                yield Cart(*row)
         except Exception as ex:
             logger.error(repr(ex))
             return
 
 
-def cancel_order_by_id(order_id: int) -> bool | None:
-    """Cancellations
+def cancel_order_by_id(order_id: int, user_id: int) -> bool | None:
+    """Cancelling an order of the user
 
     :param order_id: order id
-    :return:
+    :param user_id: id of the user cancelling the order, the order must be his
+    :return: True if cancelled
     """
     with Session(autoflush=True, bind=engine) as session:
         try:
-            order = session.query(Order).filter_by(id=order_id).first()
+            order = session.query(Order).filter(Order.id == order_id, Order.user_id == user_id).first()
             if order:
                 order.is_cancelled = True
                 session.commit()
                 return True
             else:
-                logging.warning(f'Order from id:<{order_id}> not found>')
+                logger.warning(f'Order id:<{order_id}> of user id:<{user_id}> not found')
+                return
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def remove_order_item(order_id: int, product_id: int, user_id: int) -> bool | None:
+    """Removing a product from an order of the user. The order is cancelled when its last product is removed
+
+    :param order_id: order id
+    :param product_id: product id
+    :param user_id: id of the user removing the product, the order must be his
+    :return: True if removed
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            if not session.query(Order.id).filter(Order.id == order_id, Order.user_id == user_id).first():
+                logger.warning(f'Order id:<{order_id}> of user id:<{user_id}> not found')
+                return
+            removed = session.query(OrderItem).filter(OrderItem.order_id == order_id,
+                                                      OrderItem.product_id == product_id).delete()
+            if not removed:
+                logger.warning(f'Product id:<{product_id}> not found in order id:<{order_id}>')
                 return
+            if not session.query(OrderItem.id).filter(OrderItem.order_id == order_id).first():
+                session.query(Order).filter(Order.id == order_id).update({Order.is_cancelled: True})
+            session.commit()
+            return True
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def migrate_orders() -> int:
+    """Moving products of orders created by older versions, which had product and quantity columns, to order_items
+
+    :return: number of migrated orders
+    """
+    with engine.begin() as connection:
+        if 'product' not in {column['name'] for column in inspect(connection).get_columns('orders')}:
+            return 0
+        migrated = connection.exec_driver_sql(
+            'INSERT INTO order_items (order_id, product_id, quantity, price) '
+            'SELECT orders.id, orders.product, coalesce(orders.quantity, 1), products.price FROM orders '
+            'JOIN products ON products.id = orders.product '
+            'WHERE NOT EXISTS (SELECT 1 FROM order_items WHERE order_items.order_id = orders.id)').rowcount
+
+    if migrated:
+        logger.info(f'{migrated} orders moved to order items')
+    return migrated
+
+
+def rate_limit_hit(key: str, rate: int, interval: float) -> bool | None:
+    """Taking a token from a shared token bucket: rate tokens, refilled over interval seconds
+
+    :param key: bucket key
+    :param rate: bucket size
+    :param interval: time to refill an empty bucket in seconds
+    :return: True if the request is allowed
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            refilled = 'min(:rate, tokens + (:now - updated_at) * :rate / :interval)'
+            allowed = session.execute(text(
+                f'INSERT INTO rate_limits (key, tokens, updated_at) VALUES (:key, :rate - 1, :now) '
+                f'ON CONFLICT(key) DO UPDATE SET tokens = {refilled} - 1, updated_at = :now '
+                f'WHERE {refilled} >= 1 '
+                f'RETURNING tokens'),
+                {'key': key, 'rate': rate, 'interval': interval, 'now': time.time()}).first()
+            session.commit()
+            return allowed is not None
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def remove_expired_rate_limits(interval: float, prefix: str = '') -> int | None:
+    """Removing token buckets that have not been used for interval seconds, they are full again anyway
+
+    :param interval: time to refill an empty bucket in seconds
+    :param prefix: key prefix of the limiter
+    :return: number of removed buckets
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            removed = session.query(RateLimit).filter(
+                RateLimit.key.startswith(f'{prefix}:', autoescape=True),
+                RateLimit.updated_at < time.time() - interval).delete(synchronize_session=False)
+            session.commit()
+            return removed
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def get_fsm_record(chat: str, user: str, ttl: float) -> tuple[str | None, dict, dict] | None:
+    """Getting the FSM state of a user in a chat
+
+    :param chat: chat id
+    :param user: user id
+    :param ttl: records not updated for ttl seconds are considered abandoned
+    :return: state, data and bucket or None if there is no record
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            return session.query(FSMRecord.state, FSMRecord.data, FSMRecord.bucket).filter(
+                FSMRecord.chat == chat, FSMRecord.user == user,
+                FSMRecord.updated_at >= time.time() - ttl).first()
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def save_fsm_records(records: dict[tuple[str, str], dict]) -> bool | None:
+    """Saving FSM records in one transaction. Empty records are deleted
+
+    :param records: (chat, user): {'state': ..., 'data': ..., 'bucket': ...}
+    :return: True if saved
+    """
+    now = time.time()
+    rows = [dict(record, chat=chat, user=user, updated_at=now) for (chat, user), record in records.items()
+            if record['state'] is not None or record['data'] or record['bucket']]
+    empty = [key for key, record in records.items()
+             if record['state'] is None and not record['data'] and not record['bucket']]
+
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            if rows:
+                statement = insert(FSMRecord)
+                session.execute(statement.on_conflict_do_update(
+                    index_elements=[FSMRecord.chat, FSMRecord.user],
+                    set_={column: statement.excluded[column] for column in ('state', 'data', 'bucket', 'updated_at')}
+                ), rows)
+            for chat, user in empty:
+                session.query(FSMRecord).filter(FSMRecord.chat == chat, FSMRecord.user == user).delete()
+            session.commit()
+            return True
+        except Exception as ex:
+            logger.error(repr(ex))
+            return
+
+
+def remove_expired_fsm_records(ttl: float) -> int | None:
+    """Removing abandoned conversations
+
+    :param ttl: records not updated for ttl seconds are removed
+    :return: number of removed records
+    """
+    with Session(autoflush=True, bind=engine) as session:
+        try:
+            removed = session.query(FSMRecord).filter(FSMRecord.updated_at < time.time() - ttl).delete()
+            session.commit()
+            return removed
         except Exception as ex:
             logger.error(repr(ex))
             return
@@ -0,0 +1,285 @@
+import argparse
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import tempfile
+import time
+
+from PIL import Image, ImageOps
+
+from database.models import BASE_DIR, engine
+from settings import setup_logger
+
+logger = setup_logger('database')
+
+IMAGES_DIR = os.getenv('IMAGES_DIR', fr'{BASE_DIR}/image_files')
+
+MEDIA_TYPES = {
+    b'\xff\xd8\xff': 'image/jpeg',
+    b'\x89PNG': 'image/png',
+    b'GIF8': 'image/gif',
+    b'RIFF': 'image/webp',
+    b'BM': 'image/bmp',
+}
+
+# photo files written to the temp directory by versions that sent photos from temp files
+TEMP_PHOTO_PATTERN = re.compile(r'^tmp[a-z0-9_]{8}\.jpg$')
+TEMP_PHOTO_MAX_AGE = 3600  # seconds, younger files may belong to a running process
+
+# rendition name: (maximum width and height, format, encoder options)
+RENDITIONS = {
+    'thumbnail': (480, 'WEBP', {'quality': 80, 'method': 4}),
+    'telegram': (1280, 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+}
+
+
+def image_path(image_hash: str) -> str:
+    """Getting the path of an image in the store
+
+    :param image_hash: SHA-256 of the image bytes
+    :return: file path
+    """
+    return os.path.join(IMAGES_DIR, image_hash[:2], image_hash)
+
+
+def save_image(data: bytes) -> str:
+    """Saving an image to the store. Identical images are stored once
+
+    :param data: image bytes
+    :return: SHA-256 of the image bytes
+    """
+    image_hash = hashlib.sha256(data).hexdigest()
+    path = image_path(image_hash)
+    if os.path.exists(path):
+        return image_hash
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as temp_file:
+        temp_file.write(data)
+    os.replace(temp_file.name, path)
+
+    return image_hash
+
+
+def read_image(image_hash: str) -> bytes | None:
+    """Reading an image from the store
+
+    :param image_hash: SHA-256 of the image bytes
+    :return: image bytes or None if the image is not in the store
+    """
+    try:
+        with open(image_path(image_hash), 'rb') as file:
+            return file.read()
+    except FileNotFoundError:
+        logger.warning(f'Image <{image_hash}> not found in the store')
+        return
+
+
+def delete_image(image_hash: str):
+    """Deleting an image from the store
+
+    :param image_hash: SHA-256 of the image bytes
+    :return:
+    """
+    try:
+        os.remove(image_path(image_hash))
+    except FileNotFoundError:
+        return
+
+
+def normalize_image_data(data: bytes | str) -> bytes:
+    """Converting image data stored by older versions to raw bytes.
+    add_product_from_tg used to store images as base64 text
+
+    :param data: raw or base64 encoded image
+    :return: raw image bytes
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if data.startswith(tuple(MEDIA_TYPES)):
+        return data
+    try:
+        return base64.b64decode(data, validate=True)
+    except binascii.Error:
+        return data
+
+
+def image_media_type(data: bytes) -> str:
+    """Getting the media type of an image by its signature
+
+    :param data: image bytes
+    :return: media type
+    """
+    for signature, media_type in MEDIA_TYPES.items():
+        if data.startswith(signature):
+            return media_type
+    return 'application/octet-stream'
+
+
+def stored_image_media_type(image_hash: str) -> str | None:
+    """Getting the media type of an image in the store by its signature
+
+    :param image_hash: SHA-256 of the image bytes
+    :return: media type or None if the image is not in the store
+    """
+    try:
+        with open(image_path(image_hash), 'rb') as file:
+            return image_media_type(file.read(16))
+    except FileNotFoundError:
+        return
+
+
+def build_rendition(data: bytes, max_size: int, image_format: str, **options) -> bytes:
+    """Creating a copy of an image that fits into max_size x max_size pixels.
+    The original is returned if it already fits, has the same format and is not bigger than the copy
+
+    :param data: original image bytes
+    :param max_size: maximum width and height
+    :param image_format: Pillow format name
+    :param options: encoder options
+    :return: rendition bytes
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        fits = original.width <= max_size and original.height <= max_size
+        same_format = original.format == image_format
+
+        image = ImageOps.exif_transpose(original)
+        image.thumbnail((max_size, max_size))
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        output = io.BytesIO()
+        image.save(output, image_format, **options)
+
+    if fits and same_format and output.tell() >= len(data):
+        return data
+    return output.getvalue()
+
+
+def save_renditions(data: bytes) -> dict[str, str]:
+    """Saving an image and all its renditions to the store
+
+    :param data: original image bytes
+    :return: Product hash columns: image_hash and <rendition>_hash for every rendition
+    """
+    hashes = {'image_hash': save_image(data)}
+    for name, (max_size, image_format, options) in RENDITIONS.items():
+        try:
+            rendition = build_rendition(data, max_size, image_format, **options)
+        except (OSError, ValueError) as ex:
+            logger.error(f'Rendition <{name}> of image <{hashes["image_hash"]}> not created: {repr(ex)}')
+            rendition = data
+        hashes[f'{name}_hash'] = save_image(rendition)
+
+    return hashes
+
+
+def clear_uploaded_photo(connection, product_id: int):
+    """Removing the Telegram file_id of a product photo in the migration transaction,
+    like db_middleware.clear_photo_file_id, so the changed photo is uploaded again
+
+    :param connection: connection with an open transaction
+    :param product_id: product id
+    :return:
+    """
+    connection.exec_driver_sql('DELETE FROM product_photos WHERE product_id = ?', (product_id,))
+
+
+def migrate_images() -> int:
+    """Moving images stored in the products table to the image store
+    and creating renditions for products that don't have them
+
+    :return: number of updated products
+    """
+    with engine.connect() as connection:
+        product_ids = connection.exec_driver_sql(
+            'SELECT id FROM products WHERE image_data IS NOT NULL').scalars().all()
+        not_rendered = connection.exec_driver_sql(
+            'SELECT id, image_hash, telegram_hash FROM products '
+            'WHERE image_hash IS NOT NULL AND (thumbnail_hash IS NULL OR telegram_hash IS NULL)').all()
+
+    for product_id in product_ids:
+        with engine.begin() as connection:
+            data, telegram_hash = connection.exec_driver_sql(
+                'SELECT image_data, telegram_hash FROM products WHERE id = ?', (product_id,)).one()
+            hashes = save_renditions(normalize_image_data(data))
+            connection.exec_driver_sql(
+                'UPDATE products SET image_hash = ?, thumbnail_hash = ?, telegram_hash = ?, image_data = NULL '
+                'WHERE id = ?',
+                (hashes['image_hash'], hashes['thumbnail_hash'], hashes['telegram_hash'], product_id))
+            if hashes['telegram_hash'] != telegram_hash:
+                clear_uploaded_photo(connection, product_id)
+
+    for product_id, image_hash, telegram_hash in not_rendered:
+        data = read_image(image_hash)
+        if data is None:
+            continue
+        hashes = save_renditions(data)
+        with engine.begin() as connection:
+            connection.exec_driver_sql('UPDATE products SET thumbnail_hash = ?, telegram_hash = ? WHERE id = ?',
+                                       (hashes['thumbnail_hash'], hashes['telegram_hash'], product_id))
+            if hashes['telegram_hash'] != telegram_hash:
+                clear_uploaded_photo(connection, product_id)
+
+    if product_ids:
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql('VACUUM')
+        logger.info(f'{len(product_ids)} images moved to <{IMAGES_DIR}>')
+    if not_rendered:
+        logger.info(f'Renditions created for {len(not_rendered)} products')
+
+    return len(product_ids) + len(not_rendered)
+
+
+def sweep_temp_photos(temp_dir: str = None, older_than: float = TEMP_PHOTO_MAX_AGE) -> int:
+    """Removing photo files left in the temp directory by versions that sent photos from temp files.
+    Only old tmpXXXXXXXX.jpg files with JPEG content are removed, other programs may use the directory,
+    so the sweep is started manually
+
+    :param temp_dir: directory the old version wrote to, the system temp directory by default
+    :param older_than: minimum file age in seconds, younger files are kept
+    :return: number of removed files
+    """
+    temp_dir = temp_dir or tempfile.gettempdir()
+    removed = 0
+    now = time.time()
+    for entry in os.scandir(temp_dir):
+        try:
+            if not TEMP_PHOTO_PATTERN.match(entry.name) or not entry.is_file(follow_symlinks=False) \
+                    or now - entry.stat().st_mtime <= older_than:
+                continue
+            with open(entry.path, 'rb') as file:
+                if image_media_type(file.read(16)) != 'image/jpeg':
+                    continue
+            os.remove(entry.path)
+            removed += 1
+        except OSError as ex:
+            logger.error(repr(ex))
+    logger.info(f'Removed {removed} temporary photo files from <{temp_dir}>')
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Images store maintenance')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('migrate', help='move images from the database to the store, the default command')
+    sweep_parser = commands.add_parser('sweep-temp', help='remove photo files left in the temp directory '
+                                                          'by versions that sent photos from temp files')
+    sweep_parser.add_argument('--dir', help='temp directory, the system one by default')
+    sweep_parser.add_argument('--older-than', type=float, default=TEMP_PHOTO_MAX_AGE,
+                              help='minimum file age in seconds')
+    args = parser.parse_args()
+
+    if args.command == 'sweep-temp':
+        print(sweep_temp_photos(args.dir, args.older_than))
+    else:
+        print(migrate_images())
+
+
+if __name__ == '__main__':
+    main()
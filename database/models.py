@@ -1,8 +1,10 @@
 import os
 
 from sqlalchemy import create_engine, Column, Integer, Float, String, ForeignKey, Boolean, DateTime, func, \
-    CheckConstraint, LargeBinary
-from sqlalchemy.orm import declarative_base
+    CheckConstraint, LargeBinary, JSON, Index, inspect, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, deferred
 from sqlalchemy.orm import relationship
 
 from settings import setup_logger
@@ -13,17 +15,56 @@ if not os.path.exists(f'{BASE_DIR}/db_files'):
     os.makedirs(f'{BASE_DIR}/db_files')
 
 engine_path = fr'{BASE_DIR}/db_files/bot_db.db'
-engine = create_engine(f'sqlite:///{engine_path}')
+
+DB_PROFILE = os.getenv('DB_PROFILE', 'production')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 4))
+
+# pragmas executed on every new connection
+SQLITE_PROFILES = {
+    'default': {},
+    'production': {
+        'journal_mode': 'WAL',  # readers don't block the writer
+        'synchronous': 'NORMAL',  # WAL stays consistent, fsync only on checkpoints
+        'busy_timeout': 5000,  # wait for a lock instead of raising "database is locked"
+        'cache_size': -20000,  # 20 MB page cache per connection
+        'mmap_size': 268435456,  # 256 MB memory-mapped reads
+        'temp_store': 'MEMORY',
+    },
+}
 
 Base = declarative_base()
 logger = setup_logger('database')
 
 
+def create_db_engine(path: str, profile: str = DB_PROFILE) -> Engine:
+    """Creating an SQLite engine with a pragma profile
+
+    :param path: database file path
+    :param profile: SQLITE_PROFILES key
+    :return: engine
+    """
+    pragmas = SQLITE_PROFILES[profile]
+    engine_ = create_engine(f'sqlite:///{path}', pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+
+    @event.listens_for(engine_, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+    return engine_
+
+
+engine = create_db_engine(engine_path)
+
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    telegram_id = Column(Integer, nullable=True)
-    name = Column(String, nullable=False)
+    telegram_id = Column(Integer, nullable=True, index=True)
+    name = Column(String, nullable=False, index=True)
     password = Column(String, nullable=False)
     address = Column(String)
     phone_number = Column(String)
@@ -37,23 +78,42 @@ class User(Base):
 class Product(Base):
     __tablename__ = 'products'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    name = Column(String)
+    name = Column(String, index=True)
     price = Column(Float)
     is_available = Column(Boolean)
-    image_data = Column(LargeBinary)
-    orders = relationship('Order', back_populates='products')
+    image_data = deferred(Column(LargeBinary))
+    image_hash = Column(String(64))
+    thumbnail_hash = Column(String(64))
+    telegram_hash = Column(String(64))
+    order_items = relationship('OrderItem', back_populates='product')
+
+
+class ProductPhoto(Base):
+    __tablename__ = 'product_photos'
+    product_id = Column(Integer, ForeignKey('products.id'), primary_key=True)
+    telegram_file_id = Column(String, nullable=False)
 
 
 class Order(Base):
     __tablename__ = 'orders'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
     order_time = Column(DateTime(timezone=True))
     is_cancelled = Column(Boolean, default=False)
-    quantity = Column(Integer)
     user = relationship('User', back_populates='orders')
-    product = Column(Integer, ForeignKey('products.id'))
-    products = relationship('Product', back_populates='orders')
+    items = relationship('OrderItem', back_populates='order')
+
+
+class OrderItem(Base):
+    __tablename__ = 'order_items'
+    __table_args__ = (Index('ix_order_items_order_id_product_id', 'order_id', 'product_id', unique=True),)
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    price = Column(Float, nullable=False)  # product price when the item was added
+    order = relationship('Order', back_populates='items')
+    product = relationship('Product', back_populates='order_items')
 
 
 class Comment(Base):
@@ -77,11 +137,28 @@ class Rating(Base):
 class Admin(Base):
     __tablename__ = 'admins'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), unique=True, index=True)
     admin_level = Column(Integer, CheckConstraint('admin_level BETWEEN 1 AND 2'))
     user = relationship('User', back_populates='admin_level')
 
 
+class RateLimit(Base):
+    __tablename__ = 'rate_limits'
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(Float, nullable=False, index=True)
+
+
+class FSMRecord(Base):
+    __tablename__ = 'fsm_records'
+    chat = Column(String, primary_key=True)
+    user = Column(String, primary_key=True)
+    state = Column(String)
+    data = Column(JSON, nullable=False, default=dict)
+    bucket = Column(JSON, nullable=False, default=dict)
+    updated_at = Column(Float, nullable=False, index=True)
+
+
 class SettingsHistory(Base):
     __tablename__ = 'settings_history'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
@@ -91,10 +168,60 @@ class SettingsHistory(Base):
     change_time = Column(DateTime(timezone=True), onupdate=func.now())
 
 
+class MenuVersion(Base):
+    """Menu version shared by all workers, one row changed every time products are changed"""
+    __tablename__ = 'menu_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class UserVersion(Base):
+    """Users version shared by all workers, one row changed every time users are changed"""
+    __tablename__ = 'user_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
 class BackupHistory(Base):
     __tablename__ = 'backup_history'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     backup_time = Column(DateTime(timezone=True), onupdate=func.now())
+    file_name = Column(String)
+    size = Column(Integer)
+    sha256 = Column(String(64))
+
+
+def upgrade_schema(bind: Engine = engine):
+    """Adding the columns and indexes declared in the models to tables created by older versions
+
+    :param bind: database engine
+    :return:
+    """
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+                    logger.info(f'Column <{column.name}> added to table <{table.name}>')
+
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            try:
+                index.create(bind)
+                logger.info(f'Index <{index.name}> added to table <{table.name}>')
+            except IntegrityError as ex:
+                logger.error(f'Index <{index.name}> not created: {repr(ex)}')
 
 
 Base.metadata.create_all(bind=engine)
+upgrade_schema(engine)
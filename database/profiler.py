@@ -0,0 +1,167 @@
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database.models import engine
+from settings import setup_logger
+
+logger = setup_logger('sql_profile')
+
+SQL_PROFILE = os.getenv('SQL_PROFILE', '0') == '1'
+SQL_SLOW_QUERY_MS = float(os.getenv('SQL_SLOW_QUERY_MS', 100))  # statements slower than this are logged with a plan
+SQL_PROFILE_REPEATED = 3  # a statement executed this many times in a request is reported as repeated
+
+# modules whose functions statements are attributed to
+PROFILED_MODULES = ('database.db_middleware', 'database.image_store')
+
+
+@dataclass
+class StatementRecord:
+    function: str
+    statement: str
+    duration: float
+    rows: int = 0  # changed rows for writes, fetched rows for selects, counted as they are read
+
+
+@dataclass
+class RequestProfile:
+    """Statements executed while handling a request or an update"""
+
+    name: str
+    statements: list[StatementRecord] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, record: StatementRecord):
+        with self.lock:
+            self.statements.append(record)
+
+    @property
+    def total_time(self) -> float:
+        return sum(record.duration for record in self.statements)
+
+    def summary(self) -> str:
+        with self.lock:
+            statements = list(self.statements)
+        functions = Counter(record.function for record in statements)
+        repeated = [(statement, count) for statement, count in Counter(
+            record.statement for record in statements).most_common() if count >= SQL_PROFILE_REPEATED]
+
+        summary = f'<{self.name}>: {len(statements)} queries, {self.total_time * 1000:.1f} ms, ' \
+                  f'{sum(max(record.rows, 0) for record in statements)} rows; ' \
+                  + ', '.join(f'{function} x{count}' for function, count in functions.most_common())
+        for statement, count in repeated:
+            summary += f'\nrepeated x{count}: {" ".join(statement.split())}'
+        return summary
+
+
+# profile of the request being handled, shared with the database threads through the copied context
+current_profile: ContextVar[RequestProfile | None] = ContextVar('current_profile', default=None)
+
+# engine -> slow statement threshold in seconds
+profiled_engines: dict[Engine, float] = {}
+
+
+def calling_function() -> str:
+    """Getting the outermost db_middleware function on the stack, it is the one called by the app
+
+    :return: function name or other
+    """
+    function = 'other'
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_globals.get('__name__') in PROFILED_MODULES:
+            function = frame.f_code.co_name
+        frame = frame.f_back
+    return function
+
+
+def explain(cursor, statement: str, parameters, executemany: bool) -> str:
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+    try:
+        rows = cursor.connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+    except sqlite3.Error as ex:
+        return repr(ex)
+    return '\n'.join(row[-1] for row in rows)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record = StatementRecord(calling_function(), statement, 0.0)
+    conn.info['profiler_record'] = time.perf_counter(), record
+
+    def count_row(cursor_, row):
+        record.rows += 1
+        return row
+
+    cursor.row_factory = count_row
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started, record = conn.info.pop('profiler_record')
+    record.duration = time.perf_counter() - started
+    if cursor.description is None:  # no result rows to count, the rows changed are known already
+        record.rows = cursor.rowcount
+
+    profile = current_profile.get()
+    if profile is not None:
+        profile.add(record)
+
+    if record.duration >= profiled_engines.get(conn.engine, float('inf')):
+        logger.warning(f'Slow query in <{record.function}>: {record.duration * 1000:.1f} ms, '
+                       f'{" ".join(statement.split())}\n{explain(cursor, statement, parameters, executemany)}')
+
+
+def enable_profiler(engine_: Engine = engine, slow_query_ms: float = SQL_SLOW_QUERY_MS):
+    """Recording statements of the engine: durations, rows and db_middleware functions.
+    Statements slower than the threshold are logged to logs/sql_profile.log with their query plan
+
+    :param engine_: engine
+    :param slow_query_ms: slow statement threshold in milliseconds
+    :return:
+    """
+    if engine_ not in profiled_engines:
+        event.listen(engine_, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine_, 'after_cursor_execute', after_cursor_execute)
+    profiled_engines[engine_] = slow_query_ms / 1000
+
+
+def disable_profiler(engine_: Engine = engine):
+    if profiled_engines.pop(engine_, None) is not None:
+        event.remove(engine_, 'before_cursor_execute', before_cursor_execute)
+        event.remove(engine_, 'after_cursor_execute', after_cursor_execute)
+
+
+@contextmanager
+def profile_request(name: str = 'request'):
+    """Collecting statements executed inside the block and logging their summary,
+    so repeated queries of one request, like N+1 lookups, are easy to see.
+    Does nothing when no engine is profiled
+
+    :param name: request name, can be changed through the profile before the block ends
+    :return: RequestProfile
+    """
+    profile = RequestProfile(name)
+    if not profiled_engines:
+        yield profile
+        return
+
+    token = current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        current_profile.reset(token)
+        if profile.statements:
+            logger.info(profile.summary())
+
+
+if SQL_PROFILE:
+    enable_profiler()
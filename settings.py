@@ -1,21 +1,121 @@
+import atexit
+import json
 import logging
 import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json or text
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN')  # TimedRotatingFileHandler interval, like midnight, instead of size
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+
+# logger name -> listener writing the logger's records to its file
+log_listeners: dict[str, QueueListener] = {}
+log_listeners_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'line': record.lineno,
+            'thread': record.threadName,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogQueueHandler(QueueHandler):
+    """QueueHandler that leaves formatting to the file handler.
+    Only the message and the traceback are rendered in the calling thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def create_file_handler(path: str) -> logging.Handler:
+    if LOG_ROTATE_WHEN:
+        file_handler = TimedRotatingFileHandler(path, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT,
+                                                encoding='utf-8')
+    else:
+        file_handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                           encoding='utf-8')
+    file_handler.setLevel(logging.INFO)
+    if LOG_FORMAT == 'json':
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    return file_handler
 
 
 def setup_logger(log_file: str):
+    """Getting a logger writing to logs/<log_file>.log.
+    Records are put into a queue and written by a listener thread, so logging doesn't block the caller.
+    The logger is set up once, repeated calls return it unchanged
+
+    :param log_file: logger and log file name
+    :return: logger
+    """
     logger = logging.getLogger(f'{log_file}')
-    logger.setLevel(logging.INFO)
+    with log_listeners_lock:
+        if log_file in log_listeners:
+            return logger
 
-    if not os.path.exists('logs'):
-        os.makedirs('logs')
+        logger.setLevel(logging.INFO)
 
-    log_file = os.path.join('logs', f'{log_file}.log')
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.INFO)
+        if not os.path.exists(LOG_DIR):
+            os.makedirs(LOG_DIR, exist_ok=True)
 
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, create_file_handler(os.path.join(LOG_DIR, f'{log_file}.log')),
+                                 respect_handler_level=True)
+        listener.start()
+        log_listeners[log_file] = listener
 
-    logger.addHandler(file_handler)
+        logger.addHandler(LogQueueHandler(log_queue))
 
     return logger
+
+
+def stop_logger(log_file: str):
+    """Writing queued records of a logger and stopping its listener thread
+
+    :param log_file: logger and log file name
+    :return:
+    """
+    with log_listeners_lock:
+        listener = log_listeners.pop(log_file, None)
+        if listener is None:
+            return
+        logger = logging.getLogger(log_file)
+        for handler in [handler for handler in logger.handlers if isinstance(handler, LogQueueHandler)]:
+            logger.removeHandler(handler)
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
+def stop_loggers():
+    for log_file in list(log_listeners):
+        stop_logger(log_file)
+
+
+atexit.register(stop_loggers)
@@ -1,14 +1,35 @@
+import asyncio
+import base64
 import hashlib
 import os
 import pathlib
+import shutil
+import sqlite3
+import tempfile
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
+from unittest.mock import patch
 
+from PIL import Image
+from sqlalchemy import event, create_engine, inspect
 from sqlalchemy.orm import Session
 
 from database.db_middleware import add_user, add_product, add_rating, add_comment, set_tg_id, check_is_admin_by_tg_id, \
-    change_product_is_available, get_object_by_id
-from database.models import User, Product, Rating, Comment, Base, engine, engine_path
+    change_product_is_available, get_object_by_id, get_photo_file_id, set_photo_file_id, delete_product_by_id, \
+    get_photo_by_id, add_order, get_user_cart_by_id, cancel_order_by_id, get_user_id_by_tg_id, get_product_summaries, \
+    get_menu_version, get_user_context, rate_limit_hit, remove_expired_rate_limits, UserContextCache, \
+    USER_CACHE_MISS_TTL, get_fsm_record, save_fsm_records, remove_expired_fsm_records, add_orders, add_ratings, \
+    add_to_cart, remove_order_item, migrate_orders, get_menu_page
+from database.db_async import db_function_duration, db_queries
+from database.db_async import get_menu_page as get_menu_page_async
+from database.db_backup import create_backup, verify_backup, list_backups, restore_backup
+from database.profiler import enable_profiler, disable_profiler, profile_request
+from database.image_store import IMAGES_DIR, image_path, migrate_images, sweep_temp_photos
+from database.models import User, Product, Order, OrderItem, Rating, Comment, Base, BackupHistory, engine, engine_path, \
+    upgrade_schema
 
 
 def encode_password(password: str) -> str:
@@ -32,9 +53,11 @@ class DatabaseTestCase(unittest.TestCase):
 
     @classmethod
     def tearDownClass(cls):
+        engine.dispose()
         if os.path.exists(cls.temp_db_path):
             os.remove(cls.temp_db_path)
             os.rmdir(Path(cls.temp_db_path).parent)
+        shutil.rmtree(IMAGES_DIR, ignore_errors=True)
 
     def setUp(self):
         with Session(bind=engine) as session:
@@ -121,6 +144,442 @@ class DatabaseTestCase(unittest.TestCase):
         self.assertIsInstance(result, Product)
         self.assertEqual(result.name, 'TestProduct2')
 
+    def test_photo_file_id(self):
+        product = add_product('TestProduct3', 10.0, photo_path=self.photo_path, is_available=True)
+        self.session.add(product)
+        self.session.commit()
+        self.assertIsNone(get_photo_file_id(product.id))
+        set_photo_file_id(product.id, 'file_id_1')
+        set_photo_file_id(product.id, 'file_id_2')
+        self.assertEqual(get_photo_file_id(product.id), 'file_id_2')
+        delete_product_by_id(Product, product.id)
+        self.assertIsNone(get_photo_file_id(product.id))
+
+    def test_get_photo_by_id(self):
+        product = add_product('TestProduct4', 10.0, photo_path=self.photo_path, is_available=True)
+        self.session.add(product)
+        self.session.commit()
+        with open(self.photo_path, 'rb') as file:
+            photo = file.read()
+        self.assertEqual(get_photo_by_id(product.id, rendition='original').read(), photo)
+        self.assertIsNone(get_photo_by_id(-1))
+
+        missing_hash = 'e' * 64  # not in the store
+        with engine.begin() as connection:
+            connection.exec_driver_sql('UPDATE products SET image_hash = ?, telegram_hash = ?, image_data = ? '
+                                       'WHERE id = ?', (missing_hash, missing_hash, photo, product.id))
+        with self.assertLogs('database', 'WARNING') as logs:
+            self.assertEqual(get_photo_by_id(product.id).read(), photo)
+        self.assertIn(missing_hash, logs.output[-1])
+
+        with engine.begin() as connection:
+            connection.exec_driver_sql('UPDATE products SET image_data = NULL WHERE id = ?', (product.id,))
+        with self.assertLogs('database', 'WARNING'):
+            self.assertIsNone(get_photo_by_id(product.id))
+
+    def test_get_user_cart_by_id(self):
+        add_user(name='CartUser', address='Test Address', password='TestPassword', phone_number='123456789',
+                 tg_id=7654321)
+        user_id = get_user_id_by_tg_id(7654321)
+        first = add_product('CartProduct1', 10.0, photo_path=self.photo_path, is_available=True)
+        second = add_product('CartProduct2', 2.5, photo_path=self.photo_path, is_available=True)
+        self.session.add_all([first, second])
+        self.session.commit()
+        first_order = add_order(user=user_id, order_time=datetime.now(), product=first.id, quantity=2)
+        cancelled_order = add_order(user=user_id, order_time=datetime.now(), product=first.id, quantity=1)
+        second_order = add_order(user=user_id, order_time=datetime.now(), product=second.id, quantity=4)
+        self.session.add_all([first_order, cancelled_order, second_order])
+        self.session.commit()
+        self.assertIsNone(cancel_order_by_id(first_order.id, user_id + 1000))
+        self.assertTrue(cancel_order_by_id(cancelled_order.id, user_id))
+
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            cart = list(get_user_cart_by_id(user_id))
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn('image_data', statements[0])
+        self.assertEqual([(item.name, item.quantity, item.cash, item.total, item.order_id) for item in cart],
+                         [('CartProduct1', 2, 20.0, 20.0, first_order.id),
+                          ('CartProduct2', 4, 10.0, 10.0, second_order.id)])
+
+    def test_multi_item_cart(self):
+        add_user(name='MultiItemUser', address='Test Address', password='TestPassword', phone_number='123456789',
+                 tg_id=7654322)
+        user_id = get_user_id_by_tg_id(7654322)
+        first = add_product('MultiItemProduct1', 10.0, photo_path=self.photo_path, is_available=True)
+        second = add_product('MultiItemProduct2', 2.5, photo_path=self.photo_path, is_available=True)
+        self.session.add_all([first, second])
+        self.session.commit()
+
+        order_id = add_to_cart(user_id, [(first.id, 1), (second.id, 2)])
+        self.assertEqual(add_to_cart(user_id, [(first.id, 2)]), order_id)
+        self.assertIsNone(add_to_cart(user_id, [(first.id, 1), (-1, 1)]))
+
+        cart = list(get_user_cart_by_id(user_id))
+        self.assertEqual([(item.name, item.quantity, item.cash, item.total) for item in cart],
+                         [('MultiItemProduct1', 3, 30.0, 35.0), ('MultiItemProduct2', 2, 5.0, 35.0)])
+
+        self.assertIsNone(remove_order_item(order_id, first.id, user_id + 1000))
+        self.assertTrue(remove_order_item(order_id, first.id, user_id))
+        self.assertTrue(remove_order_item(order_id, second.id, user_id))
+        self.assertEqual(list(get_user_cart_by_id(user_id)), [])
+        new_order_id = add_to_cart(user_id, [(first.id, 1)])
+        self.assertNotEqual(new_order_id, order_id)
+
+        cancel_order_by_id(new_order_id, user_id)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            order_ids = set(executor.map(lambda _: add_to_cart(user_id, [(first.id, 1)]), range(16)))
+        self.assertEqual(len(order_ids), 1)
+        self.assertEqual([item.quantity for item in get_user_cart_by_id(user_id)], [16])
+
+        self.assertFalse(delete_product_by_id(Product, first.id))  # kept for the orders
+        self.session.expire_all()
+        self.assertFalse(self.session.get(Product, first.id).is_available)
+        self.assertTrue(delete_product_by_id(Product, second.id))
+        self.assertIsNone(self.session.query(Product.id).filter(Product.id == second.id).first())
+
+    def test_migrate_orders(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            old_engine = create_engine(f'sqlite:///{os.path.join(temp_dir, "old.db")}')
+            with old_engine.begin() as connection:
+                connection.exec_driver_sql('CREATE TABLE products (id INTEGER PRIMARY KEY, name VARCHAR, price FLOAT)')
+                connection.exec_driver_sql('CREATE TABLE orders (id INTEGER PRIMARY KEY, user_id INTEGER, '
+                                           'order_time DATETIME, is_cancelled BOOLEAN, quantity INTEGER, '
+                                           'product INTEGER)')
+                connection.exec_driver_sql("INSERT INTO products VALUES (1, 'OldProduct', 3.0)")
+                connection.exec_driver_sql('INSERT INTO orders VALUES (1, 1, NULL, 0, 2, 1), (2, 1, NULL, 0, 1, 1)')
+            Base.metadata.create_all(bind=old_engine)
+
+            with patch('database.db_middleware.engine', old_engine):
+                self.assertEqual(migrate_orders(), 2)
+                self.assertEqual(migrate_orders(), 0)
+            with old_engine.connect() as connection:
+                items = connection.exec_driver_sql(
+                    'SELECT order_id, product_id, quantity, price FROM order_items ORDER BY order_id').all()
+            old_engine.dispose()
+
+        self.assertEqual(items, [(1, 1, 2, 3.0), (2, 1, 1, 3.0)])
+
+    def test_get_product_summaries(self):
+        available = add_product('SummaryProduct1', 5.0, photo_path=self.photo_path, is_available=True)
+        stopped = add_product('SummaryProduct2', 6.0, photo_path=self.photo_path, is_available=False)
+        self.session.add_all([available, stopped])
+        self.session.commit()
+
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            available_ids = [product.id for product in get_product_summaries()]
+            all_ids = [product.id for product in get_product_summaries(only_available=False)]
+            get_object_by_id(Product, available.id)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+
+        self.assertIn(available.id, available_ids)
+        self.assertNotIn(stopped.id, available_ids)
+        self.assertIn(stopped.id, all_ids)
+        self.assertFalse(any('image_data' in statement for statement in statements))
+
+    def test_get_menu_page(self):
+        products = [add_product(f'PageProduct{number}', 5.0, photo_path=self.photo_path, is_available=number != 1)
+                    for number in range(3)]
+        self.session.add_all(products)
+        self.session.commit()
+        first, hidden, last = (product.id for product in products)
+
+        page = get_menu_page(last, 'previous')
+        self.assertEqual(page.product.id, first)
+        self.assertTrue(page.has_next)
+        page = get_menu_page(first, 'next')
+        self.assertEqual(page.product.id, last)
+        self.assertTrue(page.has_previous)
+        self.assertNotEqual(page.product.id, hidden)
+        self.assertIsNone(get_menu_page(max(first, last), 'next'))
+
+    def test_image_store_deduplicates(self):
+        first = add_product('StoreProduct1', 1.0, photo_path=self.photo_path)
+        second = add_product('StoreProduct2', 1.0, photo_path=self.photo_path)
+        self.session.add_all([first, second])
+        self.session.commit()
+        with open(self.photo_path, 'rb') as file:
+            expected_hash = hashlib.sha256(file.read()).hexdigest()
+        self.assertEqual(first.image_hash, expected_hash)
+        self.assertEqual(second.image_hash, expected_hash)
+        self.assertTrue(os.path.exists(image_path(expected_hash)))
+
+        delete_product_by_id(Product, first.id)
+        self.assertTrue(os.path.exists(image_path(expected_hash)))
+
+    def test_migrate_images(self):
+        with open(self.photo_path, 'rb') as file:
+            photo = file.read()
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                'INSERT INTO products (name, price, is_available, image_data) VALUES (?, ?, ?, ?), (?, ?, ?, ?)',
+                ('LegacyProduct1', 1.0, True, photo, 'LegacyProduct2', 1.0, True, base64.b64encode(photo).decode()))
+            legacy_id = connection.exec_driver_sql("SELECT id FROM products WHERE name = 'LegacyProduct1'").scalar()
+        rendered = add_product('RenderedProduct', 1.0, photo_path=self.photo_path, is_available=True)
+        self.session.add(rendered)
+        self.session.commit()
+        with engine.begin() as connection:
+            connection.exec_driver_sql('UPDATE products SET thumbnail_hash = NULL WHERE id = ?', (rendered.id,))
+        set_photo_file_id(legacy_id, 'old-photo-file-id')
+        set_photo_file_id(rendered.id, 'rendered-file-id')
+
+        self.assertEqual(migrate_images(), 3)
+        self.assertIsNone(get_photo_file_id(legacy_id))  # the Telegram photo changed
+        self.assertEqual(get_photo_file_id(rendered.id), 'rendered-file-id')
+        products = self.session.query(Product).filter(Product.name.in_(['LegacyProduct1', 'LegacyProduct2'])).all()
+        self.assertEqual(len(products), 2)
+        for product in products:
+            self.assertEqual(product.image_hash, hashlib.sha256(photo).hexdigest())
+            self.assertIsNone(product.image_data)
+            self.assertIsNotNone(product.thumbnail_hash)
+            self.assertIsNotNone(product.telegram_hash)
+            self.assertEqual(get_photo_by_id(product.id, rendition='original').read(), photo)
+
+    def test_sweep_temp_photos(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = {'tmpabcd1234.jpg': b'\xff\xd8\xff', 'tmpyoung_12.jpg': b'\xff\xd8\xff',
+                     'tmpnotjpeg1.jpg': b'text', 'photo.jpg': b'\xff\xd8\xff'}
+            for name, data in files.items():
+                path = os.path.join(temp_dir, name)
+                pathlib.Path(path).write_bytes(data)
+                if name != 'tmpyoung_12.jpg':
+                    os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+            self.assertEqual(sweep_temp_photos(temp_dir), 1)
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['photo.jpg', 'tmpnotjpeg1.jpg', 'tmpyoung_12.jpg'])
+            self.assertEqual(sweep_temp_photos(temp_dir, older_than=0), 1)
+
+    def test_image_renditions(self):
+        product = add_product('RenditionProduct', 1.0, photo_path=self.photo_path, is_available=True)
+        self.session.add(product)
+        self.session.commit()
+
+        with Image.open(get_photo_by_id(product.id, rendition='thumbnail')) as thumbnail:
+            self.assertEqual(thumbnail.format, 'WEBP')
+            self.assertLessEqual(max(thumbnail.size), 480)
+        with Image.open(get_photo_by_id(product.id)) as telegram_photo:
+            self.assertEqual(telegram_photo.format, 'JPEG')
+            self.assertLessEqual(max(telegram_photo.size), 1280)
+        self.assertLess(os.path.getsize(image_path(product.thumbnail_hash)), os.path.getsize(self.photo_path))
+        with self.assertRaises(ValueError):
+            get_photo_by_id(product.id, rendition='preview')
+
+    def test_menu_version(self):
+        version = get_menu_version()
+        product = add_product('VersionProduct', 1.0, photo_path=self.photo_path, is_available=True)
+        self.session.add(product)
+        self.session.commit()
+        self.assertEqual(get_menu_version(), version + 1)
+        change_product_is_available(product_id=product.id, is_available=False)
+        self.assertEqual(get_menu_version(), version + 2)
+        delete_product_by_id(Product, product.id)
+        self.assertEqual(get_menu_version(), version + 3)
+
+    def test_lookups_use_indexes(self):
+        queries = {
+            'ix_users_telegram_id': self.session.query(User.id).filter(User.telegram_id == 1),
+            'ix_users_name': self.session.query(User.id).filter(User.name == 'TestUser'),
+            'ix_products_name': self.session.query(Product.id).filter(Product.name == 'TestProduct'),
+            'ix_orders_user_id': self.session.query(Order.id).filter(Order.user_id == 1),
+        }
+        for index_name, query in queries.items():
+            statement = query.statement.compile(engine, compile_kwargs={'literal_binds': True})
+            with engine.connect() as connection:
+                plan = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}').all()
+            self.assertIn(index_name, ' '.join(row[-1] for row in plan))
+
+    def test_upgrade_schema_adds_indexes(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'old.db')
+            connection = sqlite3.connect(path)
+            connection.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER, name VARCHAR, '
+                               'password VARCHAR, address VARCHAR, phone_number VARCHAR, is_admin BOOLEAN)')
+            connection.close()
+
+            old_engine = create_engine(f'sqlite:///{path}')
+            upgrade_schema(old_engine)
+            indexes = {index['name'] for index in inspect(old_engine).get_indexes('users')}
+            old_engine.dispose()
+
+        self.assertTrue({'ix_users_telegram_id', 'ix_users_name'} <= indexes)
+
+    @patch('database.db_middleware.user_context_cache', UserContextCache(check_interval=60))
+    def test_user_context_cache(self):
+        self.assertIsNone(get_user_context(5550001))
+        add_user(name='ContextUser', address='Test Address', password='TestPassword', phone_number='123456789',
+                 tg_id=5550001, is_admin=True)
+        user = get_user_context(5550001)
+        self.assertTrue(user.is_admin)
+        self.assertEqual(user.admin_level, 1)
+
+        statements = []
+
+        def count_statement(*args):
+            statements.append(args[2])
+
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            self.assertEqual(get_user_context(5550001), user)
+            self.assertTrue(check_is_admin_by_tg_id(5550001))
+            self.assertEqual(get_user_id_by_tg_id(5550001), user.id)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+        self.assertEqual(statements, [])
+
+        set_tg_id(5550002, 'ContextUser')
+        self.assertIsNone(get_user_context(5550001))
+        self.assertEqual(get_user_context(5550002).id, user.id)
+
+    def test_user_context_cache_workers(self):
+        first_worker = UserContextCache(miss_ttl=60, check_interval=0)
+        second_worker = UserContextCache(miss_ttl=60, check_interval=0)
+        with patch('database.db_middleware.user_context_cache', second_worker):
+            self.assertIsNone(get_user_context(5560001))
+
+        with patch('database.db_middleware.user_context_cache', first_worker):
+            add_user(name='WorkersUser', address='Test Address', password='TestPassword', phone_number='123456789',
+                     tg_id=5560001)
+            user = get_user_context(5560001)
+        with patch('database.db_middleware.user_context_cache', second_worker):
+            self.assertEqual(get_user_context(5560001), user)
+
+        with patch('database.db_middleware.user_context_cache', first_worker):
+            set_tg_id(5560002, 'WorkersUser')
+        with patch('database.db_middleware.user_context_cache', second_worker):
+            self.assertIsNone(get_user_context(5560001))
+            self.assertEqual(get_user_context(5560002), user)
+
+        cached = UserContextCache(check_interval=60)
+        with patch('database.db_middleware.user_context_cache', cached):
+            self.assertIsNone(get_user_context(5560003))
+        self.assertEqual(cached.get(5560003), (True, None))
+        cached.unknown.expire(time.monotonic() + USER_CACHE_MISS_TTL + 1)
+        self.assertEqual(cached.get(5560003), (False, None))
+
+    def test_rate_limit_hit(self):
+        self.assertEqual([rate_limit_hit('test:1', 3, 60) for _ in range(4)], [True, True, True, False])
+        self.assertTrue(rate_limit_hit('test:2', 3, 60))
+        self.assertTrue(rate_limit_hit('other:1', 3, 60))
+
+        self.assertEqual(remove_expired_rate_limits(-1, 'test'), 2)
+        self.assertTrue(rate_limit_hit('test:1', 3, 60))
+        self.assertEqual([rate_limit_hit('other:1', 3, 60) for _ in range(3)], [True, True, False])
+
+    def test_fsm_records(self):
+        self.assertIsNone(get_fsm_record('1', '1', 60))
+        self.assertTrue(save_fsm_records({
+            ('1', '1'): {'state': 'States:name', 'data': {'price': 10.5}, 'bucket': {}},
+            ('1', '2'): {'state': 'States:name', 'data': {}, 'bucket': {}},
+        }))
+        self.assertEqual(tuple(get_fsm_record('1', '1', 60)), ('States:name', {'price': 10.5}, {}))
+
+        self.assertTrue(save_fsm_records({('1', '1'): {'state': None, 'data': {}, 'bucket': {}}}))
+        self.assertIsNone(get_fsm_record('1', '1', 60))
+        self.assertIsNone(get_fsm_record('1', '2', -1))
+        self.assertEqual(remove_expired_fsm_records(-1), 1)
+
+    def test_bulk_insert(self):
+        add_user('BulkUser', 'Test Address', 'TestPassword', '123456789')
+        add_product('BulkProduct', 10.0, photo_path=self.photo_path)
+        product_id = self.session.query(Product.id).filter(Product.name == 'BulkProduct').scalar()
+
+        orders = [{'user': 'BulkUser', 'product': product_id, 'order_time': datetime.now(), 'quantity': 2}] * 5
+        orders[1] = dict(orders[1], user='UnknownUser')
+        orders[3] = dict(orders[3], order_time='not a date')
+        result = add_orders(orders, chunk_size=2)
+        self.assertEqual(result.inserted, 3)
+        self.assertEqual([number for number, _ in result.failed], [1, 3])
+        self.assertEqual(self.session.query(OrderItem).filter(OrderItem.product_id == product_id).count(), 3)
+
+        result = add_ratings([{'user': 'BulkUser', 'product': 'BulkProduct'},
+                              {'user': 'BulkUser', 'product': -1, 'rating_value': 5}])
+        self.assertEqual(result.inserted, 1)
+        self.assertEqual(result.failed, [(1, 'Product <-1> does not exists')])
+        self.assertEqual(self.session.query(Rating.rating_value).filter(Rating.product_id == product_id).scalar(), 4)
+
+    def test_backups(self):
+        product = add_product('BackupProduct', 5.0, photo_path=self.photo_path, is_available=True)
+        self.session.add(product)
+        self.session.commit()
+
+        with tempfile.TemporaryDirectory() as backup_dir:
+            backups = [create_backup(backup_dir=backup_dir, generations=2) for _ in range(2)]
+            unused_path = os.path.join(backup_dir, 'images', 'ff', 'f' * 64)  # used only by a removed backup
+            os.makedirs(os.path.dirname(unused_path))
+            pathlib.Path(unused_path).write_bytes(b'unused')
+            backups.append(create_backup(backup_dir=backup_dir, generations=2))
+            self.assertEqual(list_backups(backup_dir), backups[1:])
+            self.assertFalse(os.path.exists(os.path.dirname(unused_path)))
+            self.assertTrue(os.path.exists(os.path.join(backup_dir, 'images', product.image_hash[:2],
+                                                        product.image_hash)))
+            self.assertEqual(verify_backup(backups[-1], backup_dir), [])
+            history = self.session.query(BackupHistory).filter(
+                BackupHistory.file_name == os.path.basename(backups[-1])).one()
+            self.assertIsNotNone(history.backup_time)
+
+            restored_path = os.path.join(backup_dir, 'restored.db')
+            restore_backup(backups[-1], restored_path, backup_dir)
+            with sqlite3.connect(restored_path) as connection:
+                self.assertEqual(connection.execute('SELECT name FROM products WHERE id = ?', (product.id,)).fetchone(),
+                                 ('BackupProduct',))
+
+            shutil.rmtree(os.path.join(backup_dir, 'images'))
+            with open(backups[-1], 'r+b') as file:
+                file.seek(100)
+                file.write(b'broken')
+            problems = verify_backup(backups[-1], backup_dir)
+            self.assertIn('checksum does not match backup_history', problems)
+
+    def test_query_metrics(self):
+        calls = db_function_duration.get(function='get_menu_page')
+        queries = db_queries.get(function='get_menu_page')
+
+        asyncio.run(get_menu_page_async())
+
+        self.assertEqual(db_function_duration.get(function='get_menu_page'), calls + 1)
+        self.assertGreater(db_queries.get(function='get_menu_page'), queries)
+
+    def test_sql_profiler(self):
+        user = add_user(name='ProfiledUser', address='Test Address', password='TestPassword', phone_number='1')
+        product = add_product('ProfiledProduct', 5.0, photo_path=self.photo_path, is_available=True)
+        self.session.add_all([user, product])
+        self.session.commit()
+        add_to_cart(user.id, [(product.id, 2)])
+
+        enable_profiler(engine, slow_query_ms=0)
+        try:
+            with self.assertLogs('sql_profile', level='INFO') as logs, profile_request('cart') as profile:
+                carts = list(get_user_cart_by_id(user.id))
+                for _ in range(3):
+                    get_object_by_id(Product, product.id)
+        finally:
+            disable_profiler(engine)
+
+        self.assertEqual(len(carts), 1)
+        self.assertEqual([record.function for record in profile.statements],
+                         ['get_user_cart_by_id'] + ['get_object_by_id'] * 3)
+        self.assertEqual(profile.statements[0].rows, 1)
+        self.assertIn('Slow query in <get_user_cart_by_id>', logs.output[0])
+        self.assertIn('SEARCH', logs.output[0])
+        self.assertIn('<cart>: 4 queries', logs.output[-1])
+        self.assertIn('get_object_by_id x3', logs.output[-1])
+        self.assertIn('repeated x3: SELECT', logs.output[-1])
+
 
 if __name__ == '__main__':
     unittest.main()
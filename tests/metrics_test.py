@@ -0,0 +1,74 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+
+from config.middlewares import MetricsMiddleware, handler_duration  # noqa: E402
+from metrics import Counter, Gauge, Histogram, registry, render  # noqa: E402
+
+
+class MetricsTestCase(unittest.TestCase):
+    def tearDown(self):
+        for name in [name for name in registry if name.startswith('test_')]:
+            del registry[name]
+
+    def test_render(self):
+        counter = Counter('test_requests_total', 'Requests', ('path',))
+        counter.inc(path='/menu')
+        counter.inc(2, path='/menu')
+        counter.inc(path='/"cart"\n')
+        gauge = Gauge('test_queue_depth', 'Queue depth')
+        gauge.set_function(lambda: 7)
+
+        lines = render().splitlines()
+        self.assertIn('# TYPE test_requests_total counter', lines)
+        self.assertIn('test_requests_total{path="/menu"} 3', lines)
+        self.assertIn(r'test_requests_total{path="/\"cart\"\n"} 1', lines)
+        self.assertIn('test_queue_depth 7', lines)
+
+        with self.assertRaises(ValueError):
+            Counter('test_requests_total', 'Requests')
+        with self.assertRaises(ValueError):
+            counter.inc(method='GET')
+
+    def test_histogram(self):
+        histogram = Histogram('test_duration_seconds', 'Duration', ('handler',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, handler='menu')
+
+        lines = render().splitlines()
+        self.assertIn('test_duration_seconds_bucket{handler="menu",le="0.1"} 2', lines)
+        self.assertIn('test_duration_seconds_bucket{handler="menu",le="1"} 3', lines)
+        self.assertIn('test_duration_seconds_bucket{handler="menu",le="+Inf"} 4', lines)
+        self.assertIn('test_duration_seconds_sum{handler="menu"} 3.65', lines)
+        self.assertIn('test_duration_seconds_count{handler="menu"} 4', lines)
+
+
+class MetricsMiddlewareTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_handler_duration(self):
+        bot = Bot('123:abc')
+        dp = Dispatcher(bot)
+        dp.middleware.setup(MetricsMiddleware())
+
+        async def show_menu(message: types.Message):
+            await asyncio.sleep(0.01)
+
+        dp.register_message_handler(show_menu, commands=['menu'])
+        handler = f'{show_menu.__module__}.{show_menu.__qualname__}'
+
+        for text_ in ('/menu', 'Меню'):
+            await dp.process_update(types.Update(update_id=1, message={
+                'message_id': 1, 'date': 0, 'text': text_,
+                'chat': {'id': 1, 'type': 'private'}, 'from': {'id': 1, 'is_bot': False, 'first_name': 'Test'}}))
+
+        self.assertEqual(handler_duration.get(handler=handler), 1)
+        self.assertGreaterEqual(handler_duration.get(handler='unhandled'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
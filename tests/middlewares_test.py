@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+from unittest.mock import AsyncMock, patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from aiogram import Bot, Dispatcher, types  # noqa: E402
+
+from config.middlewares import UserContextMiddleware, load_user, resolve_user  # noqa: E402
+from database.db_middleware import UserContext  # noqa: E402
+
+
+def create_update(update_id: int, user_id: int = 1) -> types.Update:
+    return types.Update(update_id=update_id, message={
+        'message_id': update_id, 'date': 0, 'text': 'Меню',
+        'chat': {'id': user_id, 'type': 'private'}, 'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'}})
+
+
+class UserContextMiddlewareTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_user_is_loaded_for_every_update(self):
+        bot = Bot('123:abc')
+        dp = Dispatcher(bot)
+        dp.middleware.setup(UserContextMiddleware())
+        seen = []
+
+        async def show_menu(message: types.Message, user_context: UserContext | None):
+            seen.append((user_context, await resolve_user(message.from_user.id)))
+
+        dp.register_message_handler(show_menu)
+        registered = UserContext(id=3, is_admin=False, admin_level=None)
+        with patch('config.middlewares.get_user_context', AsyncMock(side_effect=[None, registered])) as query:
+            await dp.process_update(create_update(1))
+            await dp.process_update(create_update(2))
+
+        self.assertEqual(seen, [(None, None), (registered, registered)])
+        self.assertEqual(query.await_count, 2)
+
+    async def test_load_user_after_a_change(self):
+        registered = UserContext(id=3, is_admin=False, admin_level=None)
+        with patch('config.middlewares.get_user_context', AsyncMock(side_effect=[None, registered])):
+            self.assertIsNone(await resolve_user(1))
+            self.assertIsNone(await resolve_user(1))
+            self.assertEqual(await load_user(1), registered)
+            self.assertEqual(await resolve_user(1), registered)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from config.rate_limit import MemoryRateLimiter  # noqa: E402
+
+
+class MemoryRateLimiterTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = patch('config.rate_limit.time')
+        clock = patcher.start()
+        clock.monotonic.side_effect = lambda: self.now
+        self.addCleanup(patcher.stop)
+
+    async def test_denied_when_empty(self):
+        limiter = MemoryRateLimiter(rate=3, interval=60)
+        self.assertEqual([await limiter.hit(1) for _ in range(4)], [True, True, True, False])
+        self.assertTrue(await limiter.hit(2))
+
+        self.now += 10
+        self.assertFalse(await limiter.hit(1))
+
+    async def test_refill(self):
+        limiter = MemoryRateLimiter(rate=3, interval=60)
+        for _ in range(3):
+            await limiter.hit(1)
+
+        self.now += 20  # one token
+        self.assertTrue(await limiter.hit(1))
+        self.assertFalse(await limiter.hit(1))
+
+        self.now += 50  # two and a half tokens
+        self.assertEqual([await limiter.hit(1) for _ in range(3)], [True, True, False])
+
+    async def test_idle_buckets_expire(self):
+        limiter = MemoryRateLimiter(rate=3, interval=60)
+        await limiter.hit(1)
+        self.now += 30
+        await limiter.hit(2)
+        self.assertEqual(len(limiter), 2)
+
+        self.now += 30
+        await limiter.hit(3)
+        self.assertEqual(list(limiter.buckets), [2, 3])
+
+        self.now += 60
+        await limiter.hit(3)
+        self.assertEqual(list(limiter.buckets), [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'app'))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.staticfiles import StaticFiles  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+from database.db_middleware import bump_menu_version  # noqa: E402
+from database.image_store import save_image  # noqa: E402
+from database.models import Base, create_db_engine  # noqa: E402
+from routes import IMAGE_CACHE_CONTROL, get_home, get_image, home_page_cache  # noqa: E402
+
+
+class RoutesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_db_engine(os.path.join(self.temp_dir.name, 'routes.db'))
+        Base.metadata.create_all(bind=self.engine)
+        for target, value in (('database.db_middleware.engine', self.engine),
+                              ('database.image_store.IMAGES_DIR', os.path.join(self.temp_dir.name, 'images'))):
+            patcher = patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        app = FastAPI()
+        app.add_api_route('/', get_home, methods=['GET'])
+        app.add_api_route('/images/{image_hash}', get_image, methods=['GET'])
+        app.mount('/static', StaticFiles(directory=os.path.join(ROOT_DIR, 'app', 'static')), name='static')
+        self.client = TestClient(app)
+        home_page_cache.clear()
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def test_home_page_cache(self):
+        first = self.client.get('/', headers={'Host': 'example.com'})
+        second = self.client.get('/', headers={'Host': 'attacker.example'})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.content, second.content)
+        self.assertNotIn(b'attacker.example', second.content)
+        self.assertIn(b'href="/static/css/styles.css"', first.content)
+        self.assertEqual(len(home_page_cache), 1)
+
+        etag = first.headers['etag']
+        self.assertEqual(self.client.get('/', headers={'If-None-Match': etag}).status_code, 304)
+
+        bump_menu_version()
+        changed = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['etag'], etag)
+        self.assertEqual(len(home_page_cache), 1)
+
+    def test_image(self):
+        data = b'\x89PNG' + b'\x00' * 32
+        image_hash = save_image(data)
+        self.assertEqual(image_hash, hashlib.sha256(data).hexdigest())
+
+        response = self.client.get(f'/images/{image_hash}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, data)
+        self.assertEqual(response.headers['content-type'], 'image/png')
+        self.assertEqual(response.headers['etag'], f'"{image_hash}"')
+        self.assertEqual(response.headers['cache-control'], IMAGE_CACHE_CONTROL)
+        self.assertIn('immutable', response.headers['cache-control'])
+
+        cached = self.client.get(f'/images/{image_hash}', headers={'If-None-Match': f'"{image_hash}"'})
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b'')
+        self.assertEqual(cached.headers['etag'], f'"{image_hash}"')
+
+    def test_missing_image(self):
+        self.assertEqual(self.client.get(f'/images/{"0" * 64}').status_code, 404)
+        for image_hash in ('abc', 'G' * 64, '..%2F..%2Fsettings.py', f'{"0" * 64}.png'):
+            self.assertEqual(self.client.get(f'/images/{image_hash}').status_code, 404)
+
+    def test_home_page_behind_prefix(self):
+        client = TestClient(self.client.app, root_path='/shop')
+        self.assertIn(b'href="/shop/static/css/styles.css"', client.get('/').content)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from aiogram.utils.exceptions import RetryAfter  # noqa: E402
+
+from config.send_queue import SendQueue  # noqa: E402
+
+
+class FakeTelegram:
+    """Records requests instead of sending them"""
+
+    def __init__(self, flood_errors: int = 0):
+        self.requests = []
+        self.flood_errors = flood_errors
+
+    async def send(self, method: str, data: dict, files: dict = None):
+        if self.flood_errors:
+            self.flood_errors -= 1
+            raise RetryAfter(0)
+        await asyncio.sleep(0.01)
+        self.requests.append((time.monotonic(), method, dict(data)))
+        return {'method': method, **data}
+
+
+class SendQueueTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_chat_order_and_rate(self):
+        telegram = FakeTelegram()
+        queue = SendQueue(telegram.send, global_rate=1000, chat_rate=20, chat_burst=1)
+
+        await asyncio.gather(*(queue.put(1, 'sendMessage', {'chat_id': 1, 'text': str(number)})
+                               for number in range(5)))
+
+        self.assertEqual([data['text'] for _, _, data in telegram.requests], ['0', '1', '2', '3', '4'])
+        times = [sent for sent, _, _ in telegram.requests]
+        self.assertGreaterEqual(times[-1] - times[0], 4 / 20 - 0.01)
+
+    async def test_chats_are_concurrent(self):
+        telegram = FakeTelegram()
+        queue = SendQueue(telegram.send, global_rate=1000, chat_rate=1, chat_burst=1)
+
+        started = time.monotonic()
+        await asyncio.gather(*(queue.put(chat_id, 'sendMessage', {'chat_id': chat_id, 'text': 'Меню'})
+                               for chat_id in range(50)))
+
+        self.assertEqual(len(telegram.requests), 50)
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(queue.workers, {})
+
+    async def test_edits_are_coalesced(self):
+        telegram = FakeTelegram()
+        queue = SendQueue(telegram.send, global_rate=1000, chat_rate=1000, chat_burst=1)
+
+        results = await asyncio.gather(
+            queue.put(1, 'sendMessage', {'chat_id': 1, 'text': 'Меню'}),
+            *(queue.put(1, 'editMessageText', {'chat_id': 1, 'message_id': 10, 'text': str(number)})
+              for number in range(3)))
+
+        self.assertEqual([(method, data.get('text')) for _, method, data in telegram.requests],
+                         [('sendMessage', 'Меню'), ('editMessageText', '2')])
+        self.assertEqual([result['text'] for result in results[1:]], ['2', '2', '2'])
+
+    async def test_retry_after(self):
+        telegram = FakeTelegram(flood_errors=2)
+        queue = SendQueue(telegram.send, global_rate=1000, chat_rate=1000, chat_burst=1, retries=2)
+        self.assertEqual((await queue.put(1, 'sendMessage', {'chat_id': 1, 'text': 'Меню'}))['text'], 'Меню')
+
+        telegram.flood_errors = 3
+        with self.assertRaises(RetryAfter):
+            await queue.put(1, 'sendMessage', {'chat_id': 1, 'text': 'Меню'})
+
+
+if __name__ == '__main__':
+    unittest.main()
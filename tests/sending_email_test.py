@@ -0,0 +1,101 @@
+import asyncio
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from sending_email import MailOutbox, create_email  # noqa: E402
+
+try:
+    from aiosmtpd.controller import Controller
+    from aiosmtpd.smtp import AuthResult
+except ImportError:  # the local SMTP server is a test-only dependency
+    Controller = None
+
+
+class RejectingAuthenticator:
+    """Local SMTP server authenticator that refuses every login"""
+
+    def __init__(self):
+        self.sessions = set()
+
+    def __call__(self, server, session, envelope, mechanism, auth_data):
+        self.sessions.add(id(session))
+        return AuthResult(success=False, handled=False)
+
+
+class RecordingHandler:
+    """Local SMTP server handler that keeps received messages"""
+
+    def __init__(self, temporary_failures: int = 0):
+        self.sessions = set()
+        self.messages = []
+        self.temporary_failures = temporary_failures
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.temporary_failures:
+            self.temporary_failures -= 1
+            return '451 Try again later'
+        self.sessions.add(id(session))
+        self.messages.append(envelope.content.decode('utf-8'))
+        return '250 OK'
+
+
+@unittest.skipIf(Controller is None, 'aiosmtpd is not installed')
+class MailOutboxTestCase(unittest.IsolatedAsyncioTestCase):
+    def start_server(self, handler: RecordingHandler, authenticator: RejectingAuthenticator = None) -> MailOutbox:
+        with socket.socket() as free_socket:
+            free_socket.bind(('127.0.0.1', 0))
+            port = free_socket.getsockname()[1]
+        controller = Controller(handler, hostname='127.0.0.1', port=port,
+                                authenticator=authenticator, auth_require_tls=False)
+        controller.start()
+        self.addCleanup(controller.stop)
+        return MailOutbox('127.0.0.1', port, username='bot@example.com' if authenticator else None,
+                          password='password', starttls=False, backoff=0.05)
+
+    async def test_messages_share_connection(self):
+        handler = RecordingHandler()
+        outbox = self.start_server(handler)
+
+        for number in range(5):
+            outbox.send(create_email('bot@example.com', 'admin@example.com', f'Subject {number}', 'Text'))
+        self.assertEqual(handler.messages, [])
+        await outbox.close()
+
+        self.assertEqual(len(handler.messages), 5)
+        self.assertEqual(len(handler.sessions), 1)
+        self.assertTrue(outbox.worker.done())
+
+    async def test_temporary_failure_is_retried(self):
+        handler = RecordingHandler(temporary_failures=2)
+        outbox = self.start_server(handler)
+
+        outbox.send(create_email('bot@example.com', 'admin@example.com', 'Subject', 'Text'))
+        for _ in range(50):
+            if handler.messages:
+                break
+            await asyncio.sleep(0.05)
+        await outbox.close()
+
+        self.assertEqual(len(handler.messages), 1)
+
+    async def test_authentication_failure_is_not_retried(self):
+        handler = RecordingHandler()
+        authenticator = RejectingAuthenticator()
+        outbox = self.start_server(handler, authenticator)
+
+        for number in range(3):
+            outbox.send(create_email('bot@example.com', 'admin@example.com', f'Subject {number}', 'Text'))
+        await outbox.queue.join()
+        self.assertEqual(outbox.retrying, set())
+        await outbox.close()
+
+        self.assertEqual(handler.messages, [])
+        self.assertEqual(len(authenticator.sessions), 1)  # logged in once, not once per message
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings  # noqa: E402
+
+
+class SlowHandler(logging.Handler):
+    """Handler that takes as long as a slow disk"""
+
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+        self.records = []
+        self.done = threading.Event()
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.records.append(record)
+        self.done.set()
+
+
+class SetupLoggerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        patcher = patch.object(settings, 'LOG_DIR', self.temp_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for name in [name for name in settings.log_listeners if name.startswith('settings_test')]:
+            settings.stop_logger(name)
+        self.temp_dir.cleanup()
+
+    def read_log(self, name: str) -> list[dict]:
+        settings.stop_logger(name)
+        with open(os.path.join(self.temp_dir.name, f'{name}.log'), encoding='utf-8') as file:
+            return [json.loads(line) for line in file]
+
+    def test_setup_is_idempotent(self):
+        logger = settings.setup_logger('settings_test_idempotent')
+        self.assertIs(settings.setup_logger('settings_test_idempotent'), logger)
+        self.assertEqual(len(logger.handlers), 1)
+
+        logger.info('Меню')
+        self.assertEqual([entry['message'] for entry in self.read_log('settings_test_idempotent')], ['Меню'])
+
+    def test_json_lines(self):
+        logger = settings.setup_logger('settings_test_json')
+        logger.warning('Product <%s> does not exists', 3)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('Order not saved')
+
+        warning, error = self.read_log('settings_test_json')
+        self.assertEqual((warning['level'], warning['message']), ('WARNING', 'Product <3> does not exists'))
+        self.assertEqual(warning['logger'], 'settings_test_json')
+        self.assertEqual(error['level'], 'ERROR')
+        self.assertIn('ZeroDivisionError', error['exception'])
+
+    def test_handler_is_off_the_caller_thread(self):
+        logger = settings.setup_logger('settings_test_latency')
+        slow_handler = SlowHandler(0.05)
+        settings.log_listeners['settings_test_latency'].handlers = (slow_handler,)
+
+        started = time.perf_counter()
+        for number in range(20):
+            logger.info(f'Message {number}')
+        elapsed = time.perf_counter() - started
+
+        self.assertLess(elapsed, 0.05)
+        self.assertTrue(slow_handler.done.wait(1))
+        settings.stop_logger('settings_test_latency')
+        self.assertEqual(len(slow_handler.records), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
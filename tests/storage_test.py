@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from sqlalchemy.orm import Session  # noqa: E402
+
+from config.storage import FSM_SAVE_ATTEMPTS, SQLiteStorage  # noqa: E402
+from database.models import Base, FSMRecord, create_db_engine  # noqa: E402
+
+
+class SQLiteStorageTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.engine = create_db_engine(os.path.join(self.temp_dir.name, 'fsm.db'))
+        Base.metadata.create_all(bind=self.engine, tables=[FSMRecord.__table__])
+        patcher = patch('database.db_middleware.engine', self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def saved_records(self) -> dict:
+        with Session(bind=self.engine) as session:
+            return {(record.chat, record.user): (record.state, record.data)
+                    for record in session.query(FSMRecord)}
+
+    async def test_pending_changes_and_flush(self):
+        storage = SQLiteStorage(flush_delay=60)
+        await storage.set_state(chat=1, user=1, state='Registration:get_address')
+        await storage.update_data(chat=1, user=1, username='Test')
+
+        self.assertEqual(await storage.get_state(chat=1, user=1), 'Registration:get_address')
+        self.assertEqual(await storage.get_data(chat=1, user=1), {'username': 'Test'})
+        self.assertEqual(self.saved_records(), {})
+
+        await storage.close()
+        self.assertEqual(self.saved_records(), {('1', '1'): ('Registration:get_address', {'username': 'Test'})})
+
+        restarted = SQLiteStorage()
+        self.assertEqual(await restarted.get_data(chat=1, user=1), {'username': 'Test'})
+        await restarted.finish(chat=1, user=1)
+        await restarted.close()
+        self.assertEqual(self.saved_records(), {})
+
+    async def test_record_failing_to_save_is_dropped(self):
+        storage = SQLiteStorage(flush_delay=60)
+        await storage.update_data(chat=1, user=1, username='Test')
+        await storage.update_data(chat=2, user=2, photo=object())  # can't be written as JSON
+
+        await storage.flush()
+        self.assertEqual(self.saved_records(), {('1', '1'): (None, {'username': 'Test'})})
+        self.assertEqual(list(storage.pending), [('2', '2')])
+
+        for _ in range(FSM_SAVE_ATTEMPTS - 1):
+            await storage.flush()
+        self.assertEqual(storage.pending, {})
+        self.assertEqual(storage.failed_attempts, {})
+        await storage.close()
+
+    async def test_abandoned_records_expire(self):
+        storage = SQLiteStorage(flush_delay=60, ttl=60)
+        await storage.set_state(chat=1, user=1, state='Registration:get_address')
+        await storage.set_state(chat=2, user=2, state='Registration:get_address')
+        await storage.close()
+        with Session(bind=self.engine) as session:
+            session.query(FSMRecord).filter(FSMRecord.chat == '1').update({'updated_at': time.time() - 120})
+            session.commit()
+
+        restarted = SQLiteStorage(flush_delay=60, ttl=60)
+        self.assertIsNone(await restarted.get_state(chat=1, user=1))
+        self.assertEqual(await restarted.get_state(chat=2, user=2), 'Registration:get_address')
+
+        await restarted.flush()
+        self.assertEqual(list(self.saved_records()), [('2', '2')])
+
+
+if __name__ == '__main__':
+    unittest.main()
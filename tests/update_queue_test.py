@@ -0,0 +1,111 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot'))
+
+from aiogram import types  # noqa: E402
+
+from config.middlewares import current_user  # noqa: E402
+from config.update_queue import UpdateQueue, update_chat_id  # noqa: E402
+
+
+def create_update(update_id: int, chat_id: int, text: str = 'Меню') -> types.Update:
+    return types.Update(update_id=update_id, message={
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'}, 'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'}})
+
+
+class FakeDispatcher:
+    """Records processed updates instead of running handlers"""
+
+    def __init__(self, delay: float = 0.01):
+        self.delay = delay
+        self.processed = []
+        self.running = 0
+        self.max_running = 0
+
+    async def process(self, update: types.Update):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(self.delay)
+        self.running -= 1
+        if update.message.text == 'error':
+            raise ValueError('handler failed')
+        self.processed.append((update_chat_id(update), update.update_id))
+
+
+class UpdateQueueTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_chat_order(self):
+        dispatcher = FakeDispatcher()
+        queue = UpdateQueue(dispatcher.process, workers=4)
+
+        for update_id in range(6):
+            self.assertTrue(await queue.put(create_update(update_id, chat_id=update_id % 2)))
+        await queue.close()
+
+        self.assertEqual([update_id for chat_id, update_id in dispatcher.processed if chat_id == 0], [0, 2, 4])
+        self.assertEqual([update_id for chat_id, update_id in dispatcher.processed if chat_id == 1], [1, 3, 5])
+        self.assertEqual(dispatcher.max_running, 2)
+
+    async def test_webhook_is_not_blocked(self):
+        dispatcher = FakeDispatcher(delay=0.2)
+        queue = UpdateQueue(dispatcher.process, workers=8)
+
+        started = time.monotonic()
+        for update_id in range(20):
+            await queue.put(create_update(update_id, chat_id=update_id))
+        self.assertLess(time.monotonic() - started, 0.1)
+
+        await queue.close()
+        self.assertEqual(len(dispatcher.processed), 20)
+        self.assertEqual(dispatcher.max_running, 8)
+        self.assertLess(time.monotonic() - started, 0.2 * 3 + 0.2)
+
+    async def test_backpressure(self):
+        dispatcher = FakeDispatcher(delay=0.2)
+        queue = UpdateQueue(dispatcher.process, workers=1, size=2, timeout=0.05)
+
+        self.assertTrue(await queue.put(create_update(1, chat_id=1)))
+        self.assertTrue(await queue.put(create_update(2, chat_id=2)))
+        self.assertFalse(await queue.put(create_update(3, chat_id=3)))
+        self.assertEqual(queue.depth(), 1)  # the other one is being processed
+
+        await queue.close()
+        self.assertEqual([update_id for _, update_id in dispatcher.processed], [1, 2])
+        self.assertFalse(await queue.put(create_update(4, chat_id=4)))
+
+    async def test_duplicates_and_errors(self):
+        dispatcher = FakeDispatcher()
+        queue = UpdateQueue(dispatcher.process, workers=2)
+
+        await queue.put(create_update(1, chat_id=1, text='error'))
+        await queue.put(create_update(2, chat_id=1))
+        self.assertTrue(await queue.put(create_update(2, chat_id=1)))
+        await queue.close()
+
+        self.assertEqual(dispatcher.processed, [(1, 2)])
+        self.assertEqual(queue.chats, {})
+
+    async def test_updates_dont_share_context(self):
+        seen = []
+
+        async def process(update: types.Update):
+            seen.append(current_user.get(None))
+            current_user.set((update.message.from_user.id, None))
+
+        queue = UpdateQueue(process, workers=1)
+        current_user.set((0, None))
+        await queue.put(create_update(1, chat_id=1))
+        await queue.put(create_update(2, chat_id=1))
+        await queue.put(create_update(3, chat_id=2))
+        await queue.close()
+
+        self.assertEqual(seen, [None, None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()